@@ -0,0 +1,233 @@
+""" Lockstep simulation of many dispersed trajectories through a common sequence of phases """
+
+import numpy as np
+from scipy.integrate import odeint
+
+from EntryEquations import EnsembleEDL
+from Simulation import Cycle
+from Triggers import TriggerInput, select
+
+
+class BatchSimulation(object):
+    '''
+        Advances a batch of samples together through the same phases as a Simulation, e.g. BatchSimulation(**EntrySim()).
+
+        Each sample's current phase is tracked in an integer array. Every guidance cycle the trigger of each occupied phase is evaluated once
+        as a vectorized predicate over the samples in that phase, samples whose trigger is satisfied move on, and samples that reach Complete
+        are retired with their final state frozen. The remaining samples are propagated together with Entry.ensemble_dynamics in a single
+        odeint call per cycle. As with Simulation(integrator='odeint'), triggers are checked at guidance cycle boundaries.
+
+        Controllers and triggers receive a TriggerInput whose values are arrays over the samples in their phase, except time which is shared.
+        Triggers must therefore be array-valued predicates, as those in the Triggers module are. Controllers return a bank angle per sample
+        (a scalar is applied to every sample), or (throttle, thrust angle) in powered phases.
+
+        Methods:
+            run         - Runs a batch of samples from a common or per-sample initial state
+            postProcess - Returns a list with each sample's trajectory in the same format as Simulation.postProcess
+
+        Members:
+            times   - the common times at which the batch is logged
+            history - (len(times), N, 8) array of states; retired samples repeat their final state
+            phase   - the current phase index of each sample, len(states) once complete
+            iFinal  - the index into times at which each sample was retired
+            ie      - for each sample, the indices into times of its phase transitions
+    '''
+
+    def __init__(self, states, conditions, cycle=None, output=True):
+
+        if len(states) != len(conditions):
+            raise ValueError("Number of states must equal number of conditions.")
+
+        if cycle is None:
+            if output:
+                print "Batch simulation using default guidance cycle."
+            cycle = Cycle()
+
+        self.__states = states
+        self.__conditions = conditions
+        self.__output = output
+        try:
+            self.__iSRP = states.index('SRP')      # Phases from SRP onward are powered
+        except ValueError:
+            self.__iSRP = len(states)
+
+        self.cycle = cycle
+        self.reset()
+
+    def reset(self):
+        self.time = 0.0
+        self.times = []
+        self.history = None
+        self.control_history = None
+        self.samples = None
+        self.phase = None
+        self.iFinal = None
+        self.ie = None
+        self.aeroRatios = (1,1)
+        self.output = None
+
+    def run(self, InitialState, Controllers, InputSamples, AeroRatios=(1,1)):
+        """ Runs the batch. InputSamples is an (N,4) array of uncertainty samples (transpose the output of a chaospy sample), and
+            InitialState is either a single state shared by all samples or an (N,8) array. Returns the output of postProcess.
+        """
+
+        self.reset()
+        self.samples = np.atleast_2d(np.asarray(InputSamples, dtype=float))
+        N = self.samples.shape[0]
+        X = np.array(np.broadcast_to(InitialState, (N,8)), dtype=float)
+        U = np.zeros((N,3))
+        self.phase = np.zeros(N, dtype=int)
+        self.iFinal = np.zeros(N, dtype=int)
+        self.ie = [[0] for _ in range(N)]
+        self.aeroRatios = AeroRatios
+
+        states, controls = [], []
+        self.__log(X, U, states, controls)
+
+        nPhases = len(self.__states)
+        active = np.arange(N)
+        model = None
+        while active.size:
+            self.__transition(X, active, len(self.times)-1)
+
+            complete = self.phase[active] == nPhases
+            if np.any(complete):
+                self.iFinal[active[complete]] = len(self.times)-1
+                active = active[~complete]
+                if self.__output:
+                    print "{} of {} samples complete at t = {} s".format(N-active.size, N, self.time)
+                if not active.size:
+                    break
+                model = None
+
+            if model is None:                                               # The ensemble model is rebuilt only when the active set changes
+                model = EnsembleEDL(self.samples[active])
+                model.update_ratios(LR=AeroRatios[0], DR=AeroRatios[1])
+
+            # Controls for each occupied phase, evaluated once per phase on the samples it contains
+            for k in np.unique(self.phase[active]):
+                member = self.phase[active] == k
+                idx = active[member]
+                controller = Controllers[k]
+                command = controller(**select(controller, self.getDict(X[idx], idx)))
+                if k >= self.__iSRP:
+                    U[idx,0] = 0
+                    U[idx,1], U[idx,2] = [np.broadcast_to(c, idx.shape) for c in command]
+                else:
+                    U[idx,0] = np.broadcast_to(command, idx.shape)
+                    U[idx,1:] = 0
+
+            model.powered = np.any(self.phase[active] >= self.__iSRP)
+            u = U[active].T
+            x = odeint(model.ensemble_dynamics((u[0],u[1],u[2])), X[active].ravel(), [self.time, self.time+self.cycle.duration])[-1]
+            X[active] = x.reshape((-1,8))
+
+            self.time += self.cycle.duration
+            if self.__output and not len(self.times)%10:
+                print "current simulation time = {} s, {} samples active".format(self.time, active.size)
+            self.__log(X, U, states, controls)
+
+        self.history = np.array(states)
+        self.control_history = np.array(controls)
+        self.times = np.array(self.times)
+
+        return self.postProcess()
+
+    def __log(self, X, U, states, controls):
+        states.append(X.copy())
+        controls.append(U.copy())
+        self.times.append(self.time)
+
+    def __transition(self, X, active, i):
+        """ Advances the phase of every active sample whose trigger is satisfied, repeatedly so that several transitions may occur in one cycle. """
+
+        nPhases = len(self.__states)
+        changed = True
+        while changed:
+            changed = False
+            for k in np.unique(self.phase[active]):
+                if k == nPhases:
+                    continue
+                idx = active[self.phase[active] == k]
+                satisfied = np.broadcast_to(self.__conditions[k](self.getDict(X[idx], idx)), idx.shape)
+                if np.any(satisfied):
+                    changed = True
+                    for j in idx[satisfied]:
+                        self.phase[j] += 1
+                        self.ie[j].append(i)
+
+    def getDict(self, X, idx):
+        """ Returns the batched inputs to triggers and controllers for the states X of the samples with indices idx. """
+
+        model = EnsembleEDL(self.samples[idx])
+        model.update_ratios(LR=self.aeroRatios[0], DR=self.aeroRatios[1])
+        d =  {
+              'time'            : self.time,
+              'longitude'       : X[:,1],
+              'latitude'        : X[:,2],
+              'velocity'        : X[:,3],
+              'fpa'             : X[:,4],
+              'mass'            : X[:,7],
+              'rangeToGo'       : X[:,6],
+              'vehicle'         : model.vehicle,
+              'current_state'   : X,
+              'aero_ratios'     : (model.lift_ratio, model.drag_ratio),
+              }
+        lazy = [(('altitude',), lambda: (model.altitude(X[:,0]),)),
+                (('lift','drag'), lambda: model.aeroforces(X[:,0],X[:,3]))]
+
+        return TriggerInput(d, lazy)
+
+    def postProcess(self):
+        """ Computes the same quantities as Simulation.postProcess for the whole batch at once, and splits them into one array per sample. """
+
+        model = EnsembleEDL(self.samples)
+        model.update_ratios(LR=self.aeroRatios[0], DR=self.aeroRatios[1])
+        N = self.samples.shape[0]
+
+        X = self.history
+        r,theta,phi = X[:,:,0], np.degrees(X[:,:,1]), np.degrees(X[:,:,2])
+        v,gamma,psi = X[:,:,3], np.degrees(X[:,:,4]), np.degrees(X[:,:,5])
+        bank_cmd = np.degrees(self.control_history[:,:,0])
+
+        x0 = X[0]
+        DR,CR = model.planet.range(x0[:,1],x0[:,2],x0[:,5],lonc=X[:,:,1],latc=X[:,:,2],km=True)
+        E = model.energy(r,v,Normalized=False)
+        Ef = E[self.iFinal, np.arange(N)]
+        energy = (E-E[0])/(Ef-E[0])
+        h = model.altitude(r,km=True)
+        L,D = model.aeroforces(r,v)
+        time = np.broadcast_to(self.times[:,None], r.shape)
+
+        data = np.dstack((time, energy, bank_cmd, h, r, theta, phi, v, gamma, psi, DR, CR, L, D))
+        self.output = [data[:i+1,j] for j,i in enumerate(self.iFinal)]
+        return self.output
+
+
+def testBatch(N=100):
+    ''' Compares a batch run of a dispersed guided entry against running the same samples one at a time. '''
+    from time import time
+    from Simulation import Simulation, EntrySim, NominalEntry
+    from Uncertainty import getUncertainty
+
+    samples = getUncertainty()['parametric'].sample(N).T
+    x0, bankProfile = NominalEntry()
+
+    t0 = time()
+    batch = BatchSimulation(cycle=Cycle(1),output=False,**EntrySim())
+    output = batch.run(x0,[bankProfile],samples)
+    t_batch = time()-t0
+
+    t0 = time()
+    sim = Simulation(cycle=Cycle(1),output=False,integrator='odeint',**EntrySim())
+    serial = [sim.run(x0,[bankProfile],sample) for sample in samples]
+    t_serial = time()-t0
+
+    err = np.max([np.abs(b[-1]-s[-1])[[3,7,10,11]] for b,s in zip(output,serial)], axis=0)
+    print "Serial simulation of {} samples: {:.2f} s".format(N, t_serial)
+    print "Batch simulation of {} samples: {:.2f} s ({:.1f}x)".format(N, t_batch, t_serial/t_batch)
+    print "Maximum terminal differences: altitude {:.2g} km, velocity {:.2g} m/s, downrange {:.2g} km, crossrange {:.2g} km".format(*err)
+
+
+if __name__ == '__main__':
+    testBatch()
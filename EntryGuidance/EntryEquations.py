@@ -43,6 +43,21 @@ class Entry:
         else:
             return lambda x,t: self.dyn_model(x, t, u)
     
+    def ensemble_dynamics(self, u):
+        """ Returns a function integrable by odeint that propagates N trajectories at once.
+            The integrated state is an (N,8) array of states flattened row-wise. The planet and vehicle models may hold
+            per-sample parameter arrays (see EnsembleEDL) and each element of u may be a per-sample array.
+        """
+        return lambda x,t: self.ensemble_derivatives(x.reshape((-1,8)), t, u).ravel()
+        
+    def ensemble_derivatives(self, X, t, u):
+        """ Evaluates the derivatives of an (N,8) array of states in a single vectorized call, returned as an (N,8) array. """
+        
+        dX = self.dyn_model(X.T, t, u)
+        if self.powered:
+            dX = dX + self.__thrust_3dof(X.T, u)
+        return dX.T
+    
     # Dynamic Models
     
     #3DOF, Non-rotating Planet (i.e. Coriolis terms are excluded)
@@ -69,7 +84,7 @@ class Entry:
         dgamma = L/v*cos(sigma) + cos(gamma)*(v/r - g/v)
         dpsi = -L*sin(sigma)/v/cos(gamma) - v*cos(gamma)*cos(psi)*tan(phi)/r
         ds = -v/r*self.planet.radius*cos(gamma)
-        dm = self.vehicle.mdot(throttle)
+        dm = self.vehicle.mdot(throttle)*np.ones_like(m)
 
         return np.array([dh, dtheta, dphi, dv, dgamma, dpsi, ds, dm])
 
@@ -95,7 +110,8 @@ class Entry:
         r,theta,phi,v,gamma,psi,s,m = x
         sigma,throttle,thrustAngle = u
 
-        return np.array([0,0,0,self.vehicle.ThrustApplied*throttle*cos(thrustAngle-gamma)/m, self.vehicle.ThrustApplied*throttle*sin(thrustAngle-gamma)/(m*v), 0, 0, self.vehicle.mdot(throttle)])
+        zero = np.zeros_like(v)
+        return np.array([zero,zero,zero,self.vehicle.ThrustApplied*throttle*cos(thrustAngle-gamma)/m, self.vehicle.ThrustApplied*throttle*sin(thrustAngle-gamma)/(m*v), zero, zero, self.vehicle.mdot(throttle)*np.ones_like(v)])
     
     # Utilities
     def altitude(self, r, km=False):
@@ -116,20 +132,14 @@ class Entry:
             return E
             
     def aeroforces(self, r, v):
-        """  Returns the aerodynamic forces acting on the vehicle at a given altitude and velocity. """
+        """  Returns the aerodynamic forces acting on the vehicle at a given radius and velocity, each a scalar or an array of any shape. """
         
-        g = self.planet.mu/r**2
         h = r - self.planet.radius
-        L = np.zeros_like(h)
-        D = np.zeros_like(h)
-        for i,hi in enumerate(h):
-            rho,a = self.planet.atmosphere(hi)
-            M = v[i]/a
-            cD,cL = self.vehicle.aerodynamic_coefficients(M)
-            f = 0.5*rho*self.vehicle.area*v[i]**2/self.vehicle.mass
-            L[i] = f*cL
-            D[i] = f*cD
-        return L,D
+        rho,a = self.planet.atmosphere(h)
+        M = v/a
+        cD,cL = self.vehicle.aerodynamic_coefficients(M)
+        f = 0.5*rho*self.vehicle.area*v**2/self.vehicle.mass
+        return f*cL, f*cD
         
 def EDL(InputSample = np.zeros(4)):
     ''' A non-member utility to generate an EDL model for a given realization of uncertain parameters. '''
@@ -137,6 +147,15 @@ def EDL(InputSample = np.zeros(4)):
     CD,CL,rho0,sh = InputSample
     return Entry(PlanetModel = Planet(rho0=rho0,scaleHeight=sh), VehicleModel = EntryVehicle(CD=CD,CL=CL))  
     
+def EnsembleEDL(InputSamples):
+    ''' A non-member utility to generate a single EDL model for an (N,4) array of realizations of the uncertain parameters.
+        The planet and vehicle carry one parameter value per sample so that Entry.ensemble_dynamics can propagate all N at once. 
+    '''
+    
+    CD,CL,rho0,sh = np.asarray(InputSamples, dtype=float).T
+    return Entry(PlanetModel = Planet(rho0=rho0,scaleHeight=sh), VehicleModel = EntryVehicle(CD=CD,CL=CL))
+    
+
     
         
 class System(object):
@@ -178,11 +197,11 @@ class System(object):
         RL = x[16]
         RD = x[17]
         
-        L,D   = self.model.aeroforces(np.array([x[8]]),np.array([x[11]]))
-        Lm,Dm = self.nav.aeroforces(np.array([x[8]]),np.array([x[11]]))
+        L,D   = self.model.aeroforces(x[8],x[11])
+        Lm,Dm = self.nav.aeroforces(x[8],x[11])
         
-        dRL = FadingMemory(currentValue=RL, measuredValue=Lm[0]/L[0], gain=self.filter_gain)
-        dRD = FadingMemory(currentValue=RD, measuredValue=Dm[0]/D[0], gain=self.filter_gain)
+        dRL = FadingMemory(currentValue=RL, measuredValue=Lm/L, gain=self.filter_gain)
+        dRD = FadingMemory(currentValue=RD, measuredValue=Dm/D, gain=self.filter_gain)
         
         return np.array([dRL,dRD])
         
@@ -222,5 +241,31 @@ def CompareSaturation():
     plt.plot(x,[Saturate(xx,-1.5,1) for xx in x])        
     plt.show()
     
+def testEnsemble(N=200, tf=250):
+    ''' Compares a single ensemble integration of N dispersed trajectories against N individual integrations. '''
+    from scipy.integrate import odeint
+    from time import time
+    from Uncertainty import getUncertainty
+    
+    samples = getUncertainty()['parametric'].sample(N).T                    # (N,4)
+    bank = np.radians(np.linspace(15, 85, N))
+    r0, theta0, phi0, v0, gamma0, psi0,s0 = (3540.0e3, np.radians(-90.07), np.radians(-43.90),
+                                             5505.0,   np.radians(-14.15), np.radians(4.99),   1000e3)
+    x0 = np.array([r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0])
+    t = np.linspace(0, tf, 251)
+    
+    t0 = time()
+    X = [odeint(EDL(sample).dynamics((sigma,0,0)), x0, t)[-1] for sample,sigma in zip(samples,bank)]
+    t_serial = time()-t0
+    
+    t0 = time()
+    ensemble = EnsembleEDL(samples)
+    Xe = odeint(ensemble.ensemble_dynamics((bank,0,0)), np.tile(x0,N), t)[-1].reshape((N,8))
+    t_ensemble = time()-t0
+    
+    print "Serial integration of {} samples: {:.3f} s".format(N, t_serial)
+    print "Ensemble integration of {} samples: {:.3f} s ({:.1f}x)".format(N, t_ensemble, t_serial/t_ensemble)
+    print "Maximum relative difference in final states: {:.3g}".format(np.max(np.abs((Xe-X)/X)))
+    
 if __name__ == "__main__":
     CompareSaturation()
\ No newline at end of file
@@ -1,3 +1,7 @@
+import numpy as np
+from bisect import bisect_left
+
+
 class EntryVehicle:
     '''
     Defines an EntryVehicle Class:
@@ -17,7 +21,9 @@ class EntryVehicle:
     methods:
         mdot(throttle) - computes the mass rate of change based on the current throttle setting
         aerodynamic_coefficients(Mach) - computes the values of CD and CL for the current Mach values
+        aerodynamic_derivatives(Mach)  - computes the derivatives of CD and CL with respect to Mach
         
+    See TabulatedAero for a vehicle whose coefficients are interpolated from a table.
     '''
     
     def __init__(self, mass = 2804.0, area = 15.8, CD = 0, CL = 0, Thrust = 60375, Isp = 260, ThrustFactor = 1):
@@ -37,25 +43,189 @@ class EntryVehicle:
         return -self.Thrust*throttle/(self.ve)
         
     def aerodynamic_coefficients(self, M):
-        pD = [2.598e4, -1022.0, -2904.0, 678.6, -44.33, 1.373]
-        qD = [1.505e4, 1687.0, -2651.0, 544.1, -34.11, 1]
-        pL = [1.172e4, -3654.0, 485.6, -14.61, 0.4192]
-        qL = [2.53e4, -7846.0, 1086.0, -28.35, 1]
-        
-        num, den = 0, 0
-        for i in range(0, len(pD)):
-            num = num + pD[i]*M**i   
-        for i in range(0, len(qD)):
-            den = den + qD[i]*M**i
+        """ Evaluates the rational fits of CD and CL in Mach. M may be a scalar or an array of any shape. """
+        
+        cD = horner(pD, M)/horner(qD, M)
+        cL = horner(pL, M)/horner(qL, M)
+        return cD*(1+self.CD), cL*(1+self.CL)
+        
+    def aerodynamic_derivatives(self, M):
+        """ Evaluates the derivatives of the rational fits of CD and CL with respect to Mach. """
+        
+        return rational_derivative(pD, qD, M)*(1+self.CD), rational_derivative(pL, qL, M)*(1+self.CL)
+        
+        
+class TabulatedAero(EntryVehicle):
+    '''
+    Defines an EntryVehicle whose aerodynamic coefficients are interpolated from a table in Mach rather than evaluated from the rational fits.
+    
+    members (in addition to those of EntryVehicle):
+        Mach   - the increasing grid of Mach numbers at which the coefficients are tabulated
+        cD, cL - the undispersed drag and lift coefficients at each grid point
+        kind   - 'linear' or 'cubic', the latter a cubic Hermite interpolant
+        
+    The table is built by sampling the rational fits on a dense Mach grid, or loaded from a whitespace delimited file with columns Mach, CD, CL.
+    Cubic tables sampled from the fits use the fits' exact slopes, and loaded tables use finite difference slopes.
+    A single Mach number, as evaluated inside odeint, is interpolated in plain floats since numpy's per-call overhead dominates a scalar lookup.
+    Mach values outside of the table are clamped to its end points. The multiplicative offsets CD and CL are applied after interpolation exactly as in EntryVehicle.
+    Tables in angle of attack as well as Mach are not supported since the 3DOF state carries no angle of attack.
+    
+    methods:
+        save(filename) - writes the table in the format accepted by the table argument
+    '''
+    
+    def __init__(self, table=None, Mach=None, kind='linear', **kwargs):
+        EntryVehicle.__init__(self, **kwargs)
+        
+        if table is None:
+            if Mach is None:
+                Mach = np.linspace(0, 50, 1001)
+            self.Mach = np.asarray(Mach, dtype=float)
+            self.cD = horner(pD, self.Mach)/horner(qD, self.Mach)
+            self.cL = horner(pL, self.Mach)/horner(qL, self.Mach)
+            slopes = (rational_derivative(pD, qD, self.Mach), rational_derivative(pL, qL, self.Mach))
+        else:
+            if isinstance(table, str):
+                table = np.loadtxt(table, ndmin=2)
+            self.Mach, self.cD, self.cL = np.asarray(table, dtype=float).T[0:3]
+            slopes = (None, None)
             
-        cD = num/den
+        if np.any(np.diff(self.Mach) <= 0):
+            raise ValueError("Tabulated Mach numbers must be strictly increasing.")
+        if kind not in ('linear','cubic'):
+            raise ValueError("Interpolation kind must be 'linear' or 'cubic', not '{}'.".format(kind))
+        self.kind = kind
+        
+        self.__segments = [self.__segment_polynomials(y, dy) for y,dy in zip((self.cD, self.cL), slopes)]
+        self.__slopes = [[k*c for k,c in enumerate(coeff)][1:] for coeff in self.__segments]   # Derivatives of the segment polynomials in normalized position
+        self.__rows = [zip(*[c.tolist() for c in coeff]) for coeff in self.__segments]         # Each interval's coefficients as floats, for scalar lookups
+        self.__slope_rows = [zip(*[c.tolist() for c in coeff]) for coeff in self.__slopes]
+        self.__grid = self.Mach.tolist()
         
-        num, den = 0, 0
-        for i in range(0, len(pL)):
-            num = num + pL[i]*M**i
+        dM = np.diff(self.Mach)
+        if np.allclose(dM, dM[0]):                                              # Uniform grids locate the interval arithmetically instead of by bisection
+            self.__dM = dM[0]
+        else:
+            self.__dM = None
             
-        for i in range(0, len(qL)):
-            den = den + qL[i]*M**i
+    def __segment_polynomials(self, y, dydM=None):
+        """ Returns the coefficients, in ascending powers of the normalized position within each table interval, of the interpolant on every interval.
+            The cubic's slopes are dydM when given, otherwise finite differences.
+        """
+        
+        if self.kind == 'linear':
+            return (y[:-1], np.diff(y))
+        else:
+            dM = np.diff(self.Mach)
+            if dydM is None:
+                dydM = np.gradient(y, self.Mach)
+            m0, m1 = dydM[:-1]*dM, dydM[1:]*dM                                  # Slopes scaled by interval width so that the cubic is in normalized position
+            dy = np.diff(y)
+            return (y[:-1], m0, 3*dy - 2*m0 - m1, -2*dy + m0 + m1)
+    
+    def aerodynamic_coefficients(self, M):
+        if np.ndim(M) == 0:
+            i,s = self.__locate_scalar(M)
+            cD,cL = [horner(rows[i], s) for rows in self.__rows]
+            return cD*(1+self.CD), cL*(1+self.CL)
             
-        cL = num/den
+        i,s = self.__locate(M)
+        cD,cL = [horner([c.take(i) for c in coeff], s) for coeff in self.__segments]
         return cD*(1+self.CD), cL*(1+self.CL)
+        
+    def aerodynamic_derivatives(self, M):
+        """ The derivatives of the interpolants with respect to Mach, zero outside of the table where the coefficients are clamped. """
+        
+        if np.ndim(M) == 0:
+            if not self.__grid[0] <= M <= self.__grid[-1]:
+                return 0., 0.
+            i,s = self.__locate_scalar(M)
+            width = self.__grid[i+1] - self.__grid[i]
+            dcD,dcL = [horner(rows[i], s)/width for rows in self.__slope_rows]
+            return dcD*(1+self.CD), dcL*(1+self.CL)
+            
+        i,s = self.__locate(M)
+        width = self.Mach.take(i+1) - self.Mach.take(i)
+        inside = (M >= self.Mach[0]) & (M <= self.Mach[-1])
+        dcD,dcL = [inside*horner([c.take(i) for c in coeff], s)/width for coeff in self.__slopes]
+        return dcD*(1+self.CD), dcL*(1+self.CL)
+        
+    def __locate(self, M):
+        """ Returns the index of the table interval containing each Mach value and the normalized position within it. """
+        
+        M = np.clip(M, self.Mach[0], self.Mach[-1])
+        n = len(self.Mach)
+        if self.__dM is None:
+            i = np.clip(np.searchsorted(self.Mach, M) - 1, 0, n-2)
+            s = (M - self.Mach.take(i))/(self.Mach.take(i+1) - self.Mach.take(i))
+        else:
+            i = np.minimum(((M - self.Mach[0])/self.__dM).astype(int), n-2)
+            s = (M - self.Mach.take(i))/self.__dM
+        return i,s
+        
+    def __locate_scalar(self, M):
+        """ __locate for a single Mach number, in plain floats since numpy's per-call overhead dominates a scalar lookup. """
+        
+        grid = self.__grid
+        M = min(max(float(M), grid[0]), grid[-1])
+        if self.__dM is None:
+            i = min(max(bisect_left(grid, M) - 1, 0), len(grid)-2)
+        else:
+            i = min(int((M - grid[0])/self.__dM), len(grid)-2)
+        return i, (M - grid[i])/(grid[i+1] - grid[i])
+        
+    def save(self, filename):
+        np.savetxt(filename, np.c_[self.Mach, self.cD, self.cL], header='Mach CD CL')
+        
+        
+# Coefficients of the rational Mach fits of the aerodynamic coefficients, in ascending powers of Mach
+pD = (2.598e4, -1022.0, -2904.0, 678.6, -44.33, 1.373)
+qD = (1.505e4, 1687.0, -2651.0, 544.1, -34.11, 1)
+pL = (1.172e4, -3654.0, 485.6, -14.61, 0.4192)
+qL = (2.53e4, -7846.0, 1086.0, -28.35, 1)
+
+def horner(coeff, x):
+    """ Evaluates the polynomial sum(coeff[i]*x**i) in Horner form. x may be a scalar or an array. """
+    
+    y = coeff[-1]
+    for c in coeff[-2::-1]:
+        y = y*x + c
+    return y
+    
+def rational_derivative(p, q, x):
+    """ Evaluates the derivative of the rational function horner(p,x)/horner(q,x). """
+    
+    dp = [i*c for i,c in enumerate(p)][1:]
+    dq = [i*c for i,c in enumerate(q)][1:]
+    Q = horner(q, x)
+    return (horner(dp, x)*Q - horner(p, x)*horner(dq, x))/Q**2
+
+
+def compareAero(n=100000):
+    ''' Compares the accuracy and evaluation time of the tabulated aerodynamics against the rational fits. '''
+    from time import time
+    
+    M = np.random.uniform(0, 35, n)
+    loaded = lambda kind: TabulatedAero(table=np.c_[TabulatedAero().Mach, TabulatedAero().cD, TabulatedAero().cL], kind=kind)
+    vehicles = [('Rational fit',EntryVehicle()), ('Linear table',TabulatedAero(kind='linear')), ('Cubic table',TabulatedAero(kind='cubic')),
+                ('Loaded linear',loaded('linear')), ('Loaded cubic',loaded('cubic'))]
+    cD0,cL0 = vehicles[0][1].aerodynamic_coefficients(M)
+    
+    for name,vehicle in vehicles:
+        t0 = time()
+        for _ in range(10):
+            cD,cL = vehicle.aerodynamic_coefficients(M)
+        dt = (time()-t0)/10
+        
+        # Scalar calls dominate the cost inside odeint
+        t0 = time()
+        for m in M[:2000]:
+            vehicle.aerodynamic_coefficients(m)
+        dt_scalar = (time()-t0)/2000
+        
+        print "{:<14}: {:8.3f} ms per {} Mach values, {:6.2f} us per scalar call, max relative error CD {:.2e}, CL {:.2e}".format(
+               name, dt*1e3, n, dt_scalar*1e6, np.max(np.abs(cD/cD0-1)), np.max(np.abs(cL/cL0-1)))
+        
+        
+if __name__ == '__main__':
+    compareAero()
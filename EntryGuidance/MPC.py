@@ -2,7 +2,7 @@
 Model Predictive Controllers
 
     Standard NMPC - use a prediction model to optimize a bank profile over a receding horizon
-    Joel's NMPC - use the taylor expansion of the current state to predict a future state, and determines the optimal control over the interval
+    Joel's NMPC - use the taylor expansion of the current state to predict a future state, and determines the optimal control over the interval (taylor)
     Robust NMPC - adds a feedback control element to the nominal solution generated by an open-loop NMPC
     
 """
@@ -17,12 +17,15 @@ from scipy.integrate import odeint, trapz
 from scipy.optimize import minimize, differential_evolution, minimize_scalar
 from functools import partial
 from numpy import pi
+from time import time as clock
 import numpy as np
 
+from EntryEquations import Entry
+
 def constant(value, **kwargs):
     return value
 
-def options(N,T):
+def options(N,T,gradient=False):
     """ Defines the parameters used in NMPC """
     opt = {}
     
@@ -31,8 +34,108 @@ def options(N,T):
     
     opt['dt'] = float(T)/N  # Length of each step in the prediction
     
+    opt['gradient'] = gradient          # Whether the optimizer uses the exact gradient of the cost from the forward sensitivities (N > 1 only)
+    
+    opt['predictor'] = Predictor(opt)   # Reused by every call of the controller
+    
     return opt
 
+    
+class Predictor(object):
+    '''
+        Predicts the trajectory flown under a piecewise constant bank angle profile over the NMPC horizon.
+        
+        Built once and reused by every controller call, it propagates the nominal Entry model with fixed-step fourth order Runge-Kutta,
+        taking the number of steps per control segment needed for steps no longer than step seconds, and returns only the quantities
+        the cost depends on.
+        
+        The radius, velocity and flight path angle evolve independently of the remaining states, so their sensitivities S to each bank
+        segment obey dS/dt = A*S + B, with A the Jacobian of their dynamics and B the derivative of the flight path angle rate with respect
+        to the bank angle in the active segment. These are optionally integrated alongside the state by the same Runge-Kutta steps.
+        
+        Methods:
+            predict(state, bank, aero_ratios, sensitivities) - returns the time, velocity and drag at each step over the horizon, and with
+                                                               sensitivities=True the derivatives of velocity and drag with respect to each segment's bank angle
+    '''
+    
+    def __init__(self, control_options, step=1.0, model=None):
+        if model is None:
+            model = Entry()
+        self.model = model
+        self.N = control_options['N']
+        self.steps = max(1, int(np.ceil(control_options['dt']/step - 1e-9)))
+        self.h = control_options['dt']/self.steps
+        self.time = np.arange(self.N*self.steps+1)*self.h
+        
+    def predict(self, state, bank, aero_ratios=(1,1), sensitivities=False):
+        self.model.update_ratios(LR=aero_ratios[0], DR=aero_ratios[1])
+        h = self.h
+        n = len(state)
+        X = np.empty((len(self.time), n + sensitivities*3*self.N))
+        X[0,:n] = state
+        X[0,n:] = 0
+        i = 0
+        for k,sigma in enumerate(np.broadcast_to(bank, (self.N,))):
+            f = self.model.dynamics((sigma,0,0))
+            if sensitivities:
+                f = partial(self.__augmented, f, sigma, k, n)
+            for _ in range(self.steps):
+                x = X[i]
+                k1 = f(x, 0)
+                k2 = f(x + 0.5*h*k1, 0)
+                k3 = f(x + 0.5*h*k2, 0)
+                k4 = f(x + h*k3, 0)
+                X[i+1] = x + h/6.*(k1 + 2*k2 + 2*k3 + k4)
+                i += 1
+        
+        r,v = X[:,0], X[:,3]
+        if not sensitivities:
+            L,D = self.model.aeroforces(r, v)
+            return self.time, v, D
+            
+        L,D,L_r,L_v,D_r,D_v = self.partials(r, v)
+        S = X[:,n:].reshape((-1,3,self.N))
+        return self.time, v, D, S[:,1], D_r[:,None]*S[:,0] + D_v[:,None]*S[:,1]
+        
+    def partials(self, r, v):
+        """ Returns the lift and drag accelerations, without the aerodynamic ratios applied, and their derivatives with respect to radius and velocity. """
+        
+        planet, vehicle = self.model.planet, self.model.vehicle
+        h = r - planet.radius
+        rho,a = planet.atmosphere(h)
+        drho,da = planet.atmosphere_derivatives(h)
+        M = v/a
+        cD,cL = vehicle.aerodynamic_coefficients(M)
+        dcD,dcL = vehicle.aerodynamic_derivatives(M)
+        f = 0.5*rho*vehicle.area*v**2/vehicle.mass
+        f_r = f*drho/rho
+        f_v = 2*f/v
+        M_r = -M*da/a
+        M_v = 1/a
+        return f*cL, f*cD, f_r*cL + f*dcL*M_r, f_v*cL + f*dcL*M_v, f_r*cD + f*dcD*M_r, f_v*cD + f*dcD*M_v
+        
+    def __augmented(self, f, sigma, k, n, x, t):
+        """ The dynamics augmented with the sensitivities of the radius, velocity and flight path angle to the bank angle of each segment, k being the active segment. """
+        
+        r,v,gamma = x[0],x[3],x[4]
+        S = x[n:].reshape((3,self.N))
+        L,D,L_r,L_v,D_r,D_v = self.partials(r, v)
+        LR,DR = self.model.lift_ratio, self.model.drag_ratio
+        L,L_r,L_v = LR*L, LR*L_r, LR*L_v
+        D_r,D_v = DR*D_r, DR*D_v
+        g = self.model.planet.mu/r**2
+        g_r = -2*g/r
+        sg,cg = np.sin(gamma), np.cos(gamma)
+        cs = np.cos(sigma)
+        
+        A = np.array([[0,                                       sg,                                     v*cg],
+                      [-D_r - g_r*sg,                           -D_v,                                   -g*cg],
+                      [L_r/v*cs - cg*(v/r**2 + g_r/v),          (L_v/v - L/v**2)*cs + cg*(1/r + g/v**2), -sg*(v/r - g/v)]])
+        dS = A.dot(S)
+        dS[2,k] -= L/v*np.sin(sigma)
+        return np.concatenate((f(x[:n], t), dS.ravel()))
+        
+
 
 def controller(control_options, control_bounds, references, **kwargs):
 
@@ -40,80 +143,364 @@ def controller(control_options, control_bounds, references, **kwargs):
     
     sol = optimize(kwargs['current_state'], control_options, bounds, kwargs['aero_ratios'], references)
     
+    return command(sol.x, control_options, references, **kwargs)
+    
+def command(u, control_options, references, **kwargs):
+    """ Returns the bank angle command from the first segment of the bank magnitudes u, with the sign of the reference bank angle at the end of the horizon. """
+    
     vf = lateral(kwargs['velocity'], kwargs['drag'],kwargs['fpa'],control_options['T'])
-    if control_options['N'] > 1:
-        return sol.x[0]*np.sign(references['bank'](vf))
-    else:
-        return sol.x*np.sign(references['bank'](vf))
+    return np.atleast_1d(u)[0]*np.sign(references['bank'](vf))
+
+
+def taylor(control_options, control_bounds, references, **kwargs):
+    """ The Taylor expansion NMPC, selected in place of controller, e.g. partial(taylor, control_options=options(N=1,T=5), control_bounds=(0,pi/2), references=references).
+
+        The velocity and drag over the horizon are predicted by their second order expansions about the current state, with the derivatives
+        taken analytically from the Entry dynamics. The second derivatives are affine in the cosine of the bank angle, so the cost's drag
+        tracking integral over the prediction times is quadratic in it and is minimized in closed form. A single bank magnitude is held over
+        the horizon. The reference drag is evaluated on the velocity predicted with the reference bank angle, and then once more with the
+        solution. No trajectory is integrated.
+    """
+
+    predictor = control_options.get('predictor')
+    if predictor is None:
+        predictor = Predictor(control_options)
+    r,theta,phi,v,gamma = kwargs['current_state'][:5]
+    LR,DR = kwargs['aero_ratios']
 
+    L,D,L_r,L_v,D_r,D_v = predictor.partials(r, v)
+    L,D,D_r,D_v = LR*L, DR*D, DR*D_r, DR*D_v
+    g = predictor.model.planet.mu/r**2
+    sg,cg = np.sin(gamma), np.cos(gamma)
+
+    # First derivatives, independent of the bank angle
+    dr = v*sg
+    dv = -D - g*sg
+    dD = D_r*dr + D_v*dv
+
+    # Second derivatives as x0 + x1*cos(bank). The second partials of drag take the forms that are exact for an exponential atmosphere and constant drag coefficient.
+    dgamma = np.array([cg*(v/r - g/v), L/v])
+    ddr = np.array([sg*dv, 0]) + v*cg*dgamma
+    ddv = np.array([-dD + 2*g/r*dr*sg, 0]) - g*cg*dgamma
+    ddD = D_r*ddr + D_v*ddv + np.array([(D_r*dr + D_v*dv)**2/D - 0.5*(D_v*dv)**2/D, 0])
+
+    tau = predictor.time
+    weights = np.diff(tau)/2
+    weights = np.append(weights, 0) + np.insert(weights, 0, 0)     # The trapezoidal rule used by cost
+    lower, upper = np.cos(control_bounds[1]), np.cos(control_bounds[0])
+
+    u = np.clip(np.cos(np.radians(references['bank'](v))), lower, upper)
+    for _ in range(2):
+        vel = v + dv*tau + 0.5*tau**2*(ddv[0] + ddv[1]*u)
+        a = D + dD*tau + 0.5*tau**2*ddD[0] - references['drag'](vel)
+        b = 0.5*tau**2*ddD[1]
+        u = np.clip(-np.sum(weights*a*b)/np.sum(weights*b**2), lower, upper)
+
+    return command(np.arccos(u), control_options, references, **kwargs)
+
+
+class NMPC(object):
+    '''
+        The standard NMPC controller, keeping its solution between guidance cycles to warm start the next optimization.
+        
+        Each call shifts the previous optimal bank magnitudes forward by the time elapsed since they were computed, i.e. by one segment when
+        the guidance cycle and segment lengths are equal, holding the last segment, and uses them as the initial guess. For N=1 the bounded
+        scalar search is instead restricted to a bracket of half width bracket about the previous solution, widened to the full bounds if the
+        solution lands on its edge. The optimizer is started from scratch when warm_start is False or the time decreases, e.g. on a new run.
+
+        A shifted guess with segments on a bound tends to keep SLSQP at that corner, so such a guess is replaced by the cold guess when the
+        latter costs less. Warm starting still trades some tracking for speed since SLSQP stops within about one iteration of a nearby guess:
+        in compareNMPC(N=3,T=15) it takes about a third of the cold start's run time for an rms drag error of 3.24 m/s^2 against 3.17 m/s^2.
+
+        Used in place of partial(controller, ...), e.g. NMPC(control_options=options(N=3,T=15), control_bounds=(0,pi/2), references=references)
+        
+        With a deadline, the fraction of the guidance cycle's duration available to each solve, the wall clock time is checked after every
+        cost evaluation. Once it is exceeded the optimization is abandoned and the best bank sequence evaluated so far is used, which when
+        warm started is no worse than the shifted previous solution since that is evaluated first.
+        
+        Members:
+            stats       - per call lists of the simulation time, wall clock solve time (s), optimizer iterations (nan when the deadline was missed),
+                          cost evaluations, objective and whether the deadline was missed, collected by Simulation.run into its stats
+            iterations  - the optimizer iterations of each call (function evaluations for N=1, where the scalar search reports no iterations)
+            evaluations - the cost function evaluations of each call
+    '''
+    
+    def __init__(self, control_options, control_bounds, references, warm_start=True, bracket=0.1, deadline=None, cycle=None):
+        self.options = control_options
+        self.bounds = [control_bounds]*control_options['N']
+        self.references = references
+        self.warm_start = warm_start
+        self.bracket = bracket
+        if deadline is None:
+            self.budget = None
+        else:
+            self.budget = deadline*(1.0 if cycle is None else cycle.duration)
+        self.reset()
+        
+    def reset(self):
+        self.solution = None        # The previous optimal bank magnitudes and the time at which they were computed
+        self.stats = {'time':[], 'solve_time':[], 'iterations':[], 'evaluations':[], 'objective':[], 'missed':[]}
+        
+    @property
+    def iterations(self):
+        return self.stats['iterations']
+        
+    @property
+    def evaluations(self):
+        return self.stats['evaluations']
+        
+    def __call__(self, **kwargs):
+        time = kwargs['time']
+        guess = None
+        if self.solution is not None:
+            u, t = self.solution
+            if time < t:
+                self.reset()
+            elif self.warm_start:
+                guess = self.shift(u, time-t)
+        
+        start = clock()
+        best = [np.inf, None, 0]    # The lowest cost evaluated, its bank sequence and the number of evaluations
+        def monitor(u, J):
+            best[2] += 1
+            if J < best[0]:
+                best[0:2] = [J, np.atleast_1d(u).copy()]
+            if self.budget is not None and clock()-start > self.budget:
+                raise DeadlineExceeded()
+                
+        try:
+            sol = optimize(kwargs['current_state'], self.options, self.bounds, kwargs['aero_ratios'], self.references, guess=guess, bracket=self.bracket, monitor=monitor)
+            u, J, iterations, missed = np.atleast_1d(sol.x).copy(), sol.fun, sol.get('nit', sol.nfev), False
+        except DeadlineExceeded:
+            u, J, iterations, missed = np.clip(best[1], *self.bounds[0]), best[0], np.nan, True
+            
+        for key,value in zip(('time','solve_time','iterations','evaluations','objective','missed'), (time, clock()-start, iterations, best[2], J, missed)):
+            self.stats[key].append(value)
+        self.solution = (u, time)
+        
+        return command(u, self.options, self.references, **kwargs)
+        
+    def shift(self, u, elapsed):
+        """ Returns the previous piecewise constant bank magnitudes u, computed elapsed seconds ago, at the start of each current segment. """
+        
+        segment = np.floor((np.arange(len(u))*self.options['dt'] + elapsed)/self.options['dt'] + 1e-9).astype(int)
+        return u[np.minimum(segment, len(u)-1)]
+        
+        
+class DeadlineExceeded(Exception):
+    """ Raised from within an optimization to abandon it when its time budget is spent. """
+    pass
+    
+        
+def trilinear(axes, table, point):
+    """ Trilinear interpolation in table, whose first three dimensions are tabulated at the increasing values in axes, at the point, clamped to the table.
+        An axis with a single value is constant along it. Written out since scipy's interpolators cost hundreds of microseconds per scalar call.
+    """
+    
+    index, weight = [], []
+    for axis, x in zip(axes, point):
+        if len(axis) == 1:
+            index.append(0)
+            weight.append(0.)
+            continue
+        i = min(max(np.searchsorted(axis, x) - 1, 0), len(axis)-2)
+        index.append(i)
+        weight.append(min(max((x - axis[i])/(axis[i+1] - axis[i]), 0.), 1.))
+    i,j,k = index
+    a,b,c = weight
+    cube = table[i:i+2, j:j+2, k:k+2]                   # The slices hold a single entry along singleton axes, hence the [-1] indexing below
+    face = cube[0]*(1-a) + cube[-1]*a
+    edge = face[0]*(1-b) + face[-1]*b
+    return edge[0]*(1-c) + edge[-1]*c
+    
+
+class ExplicitMPC(object):
+    '''
+        An explicit form of the N=1 NMPC controller, interpolating bank angle magnitudes that were optimized offline over a grid of velocity,
+        drag error (drag less the reference drag at the same velocity) and flight path angle by buildExplicitMPC.
+        
+        Each grid point is solved from the state of the nominal model with that velocity, flight path angle and drag, so the table reproduces the
+        online controller whenever the measured drag is that of the prediction model. The table holds for the aerodynamic ratios it was built
+        for; on calls with other ratios the controller falls back to solving online, as it does outside of the grid if online is True
+        (otherwise the inputs are clamped to the grid). The sign of the command is determined exactly as in controller.
+        
+        Methods:
+            lookup(velocity, drag_error, fpa) - interpolates the bank angle magnitude
+            save(filename)                    - saves the table, which ExplicitMPC.load(filename, references) restores
+    '''
+    
+    def __init__(self, axes, table, control_options, control_bounds, references, aero_ratios=(1,1), online=True):
+        
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.table = np.asarray(table, dtype=float)
+        self.options = control_options
+        self.bounds = control_bounds
+        self.references = references
+        self.aero_ratios = aero_ratios
+        self.online = online
+        self.lower = np.array([axis[0] for axis in self.axes])
+        self.upper = np.array([axis[-1] for axis in self.axes])
+        
+    def lookup(self, velocity, drag_error, fpa):
+        """ Trilinear interpolation of the table. """
+        
+        return trilinear(self.axes, self.table, (velocity, drag_error, fpa))
+        
+    def __call__(self, **kwargs):
+        point = np.array([kwargs['velocity'], kwargs['drag']-self.references['drag'](kwargs['velocity']), kwargs['fpa']])
+        inside = np.all(point >= self.lower) and np.all(point <= self.upper)
+        if not np.allclose(kwargs['aero_ratios'], self.aero_ratios) or (self.online and not inside):
+            return controller(self.options, self.bounds, self.references, **kwargs)
+        return command(self.lookup(*point), self.options, self.references, **kwargs)
+        
+    def save(self, filename):
+        np.savez(filename, velocity=self.axes[0], drag_error=self.axes[1], fpa=self.axes[2], table=self.table, 
+                 T=self.options['T'], bounds=self.bounds, aero_ratios=self.aero_ratios)
+    
+    @staticmethod
+    def load(filename, references, online=True):
+        data = np.load(filename)
+        return ExplicitMPC([data['velocity'], data['drag_error'], data['fpa']], data['table'], options(N=1, T=float(data['T'])), 
+                           tuple(data['bounds']), references, tuple(data['aero_ratios']), online)
+                           
+                           
+def buildExplicitMPC(references, T=5, control_bounds=(0,pi/2), velocity=np.linspace(500,5500,26), drag_error=20*np.linspace(-1,1,17)*np.abs(np.linspace(-1,1,17)),
+                     fpa=np.radians(np.linspace(-20,5,21)), aero_ratios=(1,1), mass=8500., workers=None):
+    ''' Solves the N=1 NMPC problem at every point of a grid of velocity, drag error and flight path angle over a process pool, returning an ExplicitMPC.
+        The default drag error grid is quadratically spaced since the optimal bank angle saturates within a few m/s^2 of zero error.
+    '''
+    from MonteCarlo import parallelMap
+    
+    control_options = options(N=1, T=T)
+    model = control_options['predictor'].model
+    points = [(v, e, gamma) for v in velocity for e in drag_error for gamma in fpa]
+    
+    def solve(point):
+        v, e, gamma = point
+        state = gridState(model, v, references['drag'](v)+e, gamma, mass)
+        return optimize(state, control_options, [control_bounds], aero_ratios, references).x
+        
+    table = np.reshape(parallelMap(solve, points, workers=workers), (len(velocity), len(drag_error), len(fpa)))
+    return ExplicitMPC([velocity, drag_error, fpa], table, control_options, control_bounds, references, aero_ratios)
+    
+def gridState(model, velocity, drag, fpa, mass=8500., hmax=150e3):
+    ''' Returns a state of the model with the given velocity, flight path angle and drag, clamping the altitude to [0, hmax] when no such altitude exists. '''
+    from scipy.optimize import brentq
+    
+    R = model.planet.radius
+    excess = lambda h: model.aeroforces(R+h, velocity)[1] - drag       # Drag decreases with altitude
+    if excess(0) <= 0:
+        h = 0.
+    elif excess(hmax) >= 0:
+        h = hmax
+    else:
+        h = brentq(excess, 0, hmax, xtol=1e-3)
+    return np.array([R+h, 0, 0, velocity, fpa, 0, 0, mass])
+    
+def validateExplicitMPC(explicit, n=200):
+    ''' Compares the table's interpolated bank angle magnitudes against online solutions at random points within the grid. '''
+    from time import time
+    
+    model = explicit.options['predictor'].model
+    points = np.random.uniform(explicit.lower, explicit.upper, (n,3))
+    
+    t0 = time()
+    table = np.array([explicit.lookup(*point) for point in points])
+    t_table = (time()-t0)/n
+    t0 = time()
+    online = np.array([optimize(gridState(model, v, explicit.references['drag'](v)+e, gamma), explicit.options, [explicit.bounds], explicit.aero_ratios, explicit.references).x 
+                       for v,e,gamma in points]).flatten()
+    t_online = (time()-t0)/n
+    
+    err = np.degrees(np.abs(table-online))
+    print "Table lookup {:.1f} us, online solution {:.1f} ms per call".format(t_table*1e6, t_online*1e3)
+    print "Bank angle magnitude error (deg): median {:.2f}, 95th percentile {:.2f}, max {:.2f}".format(np.median(err), np.percentile(err, 95), err.max())
+    return err
+    
+    
 def lateral(velocity,drag,fpa,T):
     vdot = drag*np.sin(fpa)-3.7
     vf = velocity + T*vdot
     return vf
         
-def optimize(current_state, control_options, control_bounds, aero_ratios, reference):
-    from Simulation import Simulation, NMPCSim
-    
+def optimize(current_state, control_options, control_bounds, aero_ratios, reference, guess=None, bracket=0.1, monitor=None):
+    """ Optimizes the bank angle magnitudes over the horizon. monitor(u, J), if given, is called after every cost evaluation and may raise to stop the optimization. """
     
-    sim = Simulation(output=False, **NMPCSim(control_options))
+    predictor = control_options.get('predictor')
+    if predictor is None:
+        predictor = Predictor(control_options)
+        
+    objective = cost
+    if monitor is not None:
+        def objective(u, *args):
+            value = cost(u, *args)
+            monitor(u, value[0] if isinstance(value, tuple) else value)
+            return value
 
-    guess = [pi/6]*control_options['N']
+    if guess is None:
+        guess = [pi/6]*control_options['N']
+        warm = False
+    else:
+        warm = True
     if control_options['N'] > 1:
-        scalar = False
-        # sol = minimize(cost, guess, args=(sim, current_state, aero_ratios, reference), 
+        gradient = control_options.get('gradient', False)
+        if warm and saturated(guess, control_bounds):
+            # A guess shifted into a bound tends to keep SLSQP at that corner, so it is started from the cold guess instead if that costs less
+            cold = [pi/6]*control_options['N']
+            if objective(cold, predictor, current_state, aero_ratios, reference) < objective(guess, predictor, current_state, aero_ratios, reference):
+                guess = cold
+        # sol = minimize(cost, guess, args=(predictor, current_state, aero_ratios, reference), 
                        # method='L-BFGS-B', bounds=control_bounds, tol=1e-2, options={'disp':False}) # Seems to work okay!
-        sol = minimize(cost, guess, args=(sim, current_state, aero_ratios, reference, scalar), 
+        sol = minimize(objective, guess, args=(predictor, current_state, aero_ratios, reference, gradient), jac=gradient,
                        method='SLSQP', bounds=control_bounds, tol=1e-4, options={'disp':False}) # Seems to work okay!               
     # sol = differential_evolution(cost, args=(sim, x0), bounds=bounds, tol=1e-1, disp=True)
+    elif warm:
+        lower, upper = control_bounds[0]
+        local = (max(lower, guess[0]-bracket), min(upper, guess[0]+bracket))
+        sol = minimize_scalar(objective, method='Bounded', bounds=local, args=(predictor, current_state, aero_ratios, reference))
+        if (sol.x-local[0] < 1e-3 and local[0] > lower) or (local[1]-sol.x < 1e-3 and local[1] < upper):
+            nfev = sol.nfev
+            sol = minimize_scalar(objective, method='Bounded', bounds=control_bounds[0], args=(predictor, current_state, aero_ratios, reference))
+            sol.nfev += nfev
     else:
-        scalar = True
-        sol = minimize_scalar(cost, method='Bounded', bounds=control_bounds[0], args=(sim, current_state, aero_ratios, reference, scalar))
+        sol = minimize_scalar(objective, method='Bounded', bounds=control_bounds[0], args=(predictor, current_state, aero_ratios, reference))
     
     return sol
     
-def cost(u, sim, state, ratios, reference, scalar):
-    if scalar:
-        controls = [partial(constant,value=u)]
-    else:
-        controls = [partial(constant, value=v) for v in u]
-    output = sim.run(state, controls, AeroRatios=ratios)
-    time = output[:,0]
-    drag = output[:,13]
-    vel = output[:,7]
-    range = output[:,10]
-    fpa = np.radians(output[:,8])
-    # lift = output[:,12]
-    
-    if 1:                                   # Pure drag tracking
-        drag_ref = reference['drag'](vel)
-        integrand = 1*(drag-drag_ref)**2
+def saturated(u, control_bounds, tol=1e-3):
+    """ Whether any of the bank angle magnitudes u lies on its bound. """
+    return any(x-lower < tol or upper-x < tol for x,(lower,upper) in zip(np.atleast_1d(u), control_bounds))
+    
+def cost(u, predictor, state, ratios, reference, gradient=False):
+    """ The drag tracking cost of the bank angle sequence u, and with gradient=True also its gradient with respect to u. """
+    if gradient:
+        time, vel, drag, dvel, ddrag = predictor.predict(state, u, ratios, sensitivities=True)
     else:
-        drag_ref = reference['dragcos'](vel) # Tracking D/cos(fpa) - which is the true integrand in energy integral
-        integrand = 1*(drag/np.cos(fpa)-drag_ref)**2
+        time, vel, drag = predictor.predict(state, u, ratios)
+    
+    drag_ref = reference['drag'](vel)           # Pure drag tracking. Tracking D/cos(fpa) with reference['dragcos'] is the true integrand in energy integral
+    integrand = 1*(drag-drag_ref)**2
     
     # rtg_ref = reference['range'](vel)/1000
     
+    if gradient:
+        dv = 1e-2                               # The reference interpolant provides no derivative
+        slope = (reference['drag'](vel+dv) - reference['drag'](vel-dv))/(2*dv)
+        dintegrand = 2*(drag-drag_ref)[:,None]*(ddrag - slope[:,None]*dvel)
+        return trapz(integrand, time), trapz(dintegrand, time, axis=0)
+    
     return trapz(integrand, time)
     
     
 def testNMPC():
-    from Simulation import Simulation, Cycle, EntrySim, SRP
+    from Simulation import Simulation, Cycle, NominalReference
     import matplotlib.pyplot as plt
-    from ParametrizedPlanner import HEPBank
     # from JBG import controller as srp_control
     from Triggers import AccelerationTrigger, VelocityTrigger, RangeToGoTrigger
     from Uncertainty import getUncertainty
     
     # Plan the nominal profile:
-    reference_sim = Simulation(cycle=Cycle(1),output=False,**EntrySim())
-    bankProfile = lambda **d: HEPBank(d['time'],*[ 165.4159422 ,  308.86420218,  399.53393904])
-    
-    r0, theta0, phi0, v0, gamma0, psi0,s0 = (3540.0e3, np.radians(-90.07), np.radians(-43.90),
-                                             5505.0,   np.radians(-14.15), np.radians(4.99),   1000e3)
-                                             
-    x0 = np.array([r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0])
-    output = reference_sim.run(x0,[bankProfile])
-
+    x0, bankProfile, reference_sim = NominalReference()
     references = reference_sim.getRef()
     drag_ref = references['drag']
     
@@ -140,8 +527,8 @@ def testNMPC():
     sample = None 
     # sample = perturb.sample()
     # sample = [ 0.0319597,   -0.01117027,  0.0, 0.0]
-    x0_nav = [r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0] # Errors in velocity and mass
-    x0_full = np.array([r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0] + x0_nav + [1,1] + [np.radians(-15),0])
+    x0_nav = list(x0) # Errors in velocity and mass
+    x0_full = np.array(list(x0) + x0_nav + [1,1] + [np.radians(-15),0])
 
     if 1:
         output = sim.run(x0, controls, sample, FullEDL=False)
@@ -166,5 +553,75 @@ def testNMPC():
     sim.show()
     
     
+def compareNMPC(N=3, T=15):
+    ''' Compares the optimizer iterations, run time and tracking of closed loop NMPC with and without warm starting and exact gradients. '''
+    from time import time
+    from Simulation import Simulation, Cycle, NominalReference
+    from Triggers import AccelerationTrigger, VelocityTrigger
+    
+    x0, bankProfile, reference_sim = NominalReference()
+    references = reference_sim.getRef()
+    
+    for warm, gradient in ((False,False), (True,False), (False,True), (True,True)):
+        sim = Simulation(cycle=Cycle(1), output=False, states=['PreEntry','Entry'], conditions=[AccelerationTrigger('drag',4), VelocityTrigger(500)])
+        mpc = NMPC(control_options=options(N=N,T=T,gradient=gradient), control_bounds=(0,pi/2), references=references, warm_start=warm)
+        pre = partial(constant, value=bankProfile(time=0))
+        t0 = time()
+        output = sim.run(x0, [pre,mpc], [0.05,-0.05,0.05,0.0])
+        Derr = output[:,13]-references['drag'](output[:,7])
+        print "{} start, {} gradient: {:.2f} s, {:.2f} iterations and {:.1f} cost evaluations per cycle, rms drag error {:.3f} m/s^2".format(
+               'Warm' if warm else 'Cold', 'exact' if gradient else 'finite difference', time()-t0, np.mean(mpc.iterations), np.mean(mpc.evaluations), np.sqrt(np.mean(Derr[output[:,0] > 60]**2)))
+    
+    
+def compareTaylor(T=5):
+    ''' Compares the per call latency and drag tracking of the Taylor expansion NMPC and the integrating NMPC on the testNMPC scenario, nominal and dispersed. '''
+    from time import time
+    from Simulation import Simulation, Cycle, NominalReference
+    from Triggers import AccelerationTrigger, VelocityTrigger
+
+    x0, bankProfile, reference_sim = NominalReference()
+    references = reference_sim.getRef()
+
+    option_dict = options(N=1,T=T)
+    for sample in (None, [0.05,-0.05,0.05,0.0]):
+        for name,law in (('Integrating',controller), ('Taylor',taylor)):
+            latency = []
+            def timed(**kwargs):
+                t0 = time()
+                bank = law(control_options=option_dict, control_bounds=(0,pi/2), references=references, **kwargs)
+                latency.append(time()-t0)
+                return bank
+            sim = Simulation(cycle=Cycle(1), output=False, states=['PreEntry','Entry'], conditions=[AccelerationTrigger('drag',4), VelocityTrigger(500)])
+            pre = partial(constant, value=bankProfile(time=0))
+            output = sim.run(x0, [pre,timed], sample)
+            latency = 1e3*np.array(latency)
+            Derr = output[:,13]-references['drag'](output[:,7])
+            print "{} NMPC, {} sample: median {:.2f} ms, max {:.2f} ms per call, rms drag error {:.3f} m/s^2, final downrange {:.1f} km, altitude {:.2f} km".format(
+                   name, 'nominal' if sample is None else 'dispersed', np.median(latency), latency.max(), np.sqrt(np.mean(Derr[output[:,0] > 60]**2)), output[-1,10], output[-1,3])
+
+
+def testDeadline(N=3, T=15, deadline=0.05):
+    ''' Runs closed loop NMPC with and without a deadline on each solve, and reports the latency distribution collected by the simulation. '''
+    from Simulation import Simulation, Cycle, NominalReference
+    from Triggers import AccelerationTrigger, VelocityTrigger
+    
+    x0, bankProfile, reference_sim = NominalReference()
+    references = reference_sim.getRef()
+    
+    cycle = Cycle(1)
+    for limit in (None, deadline):
+        sim = Simulation(cycle=cycle, output=False, states=['PreEntry','Entry'], conditions=[AccelerationTrigger('drag',4), VelocityTrigger(500)])
+        mpc = NMPC(control_options=options(N=N,T=T), control_bounds=(0,pi/2), references=references, warm_start=False, deadline=limit, cycle=cycle)
+        pre = partial(constant, value=bankProfile(time=0))
+        output = sim.run(x0, [pre,mpc], [0.05,-0.05,0.05,0.0])
+        
+        stats = sim.stats['Entry']
+        latency = 1e3*np.array(stats['solve_time'])
+        Derr = output[:,13]-references['drag'](output[:,7])
+        print "Deadline {}: solve time median {:.1f} ms, 95th percentile {:.1f} ms, max {:.1f} ms, {} of {} deadlines missed, rms drag error {:.3f} m/s^2".format(
+               'none' if limit is None else '{} s'.format(limit*cycle.duration), np.median(latency), np.percentile(latency, 95), latency.max(),
+               sum(stats['missed']), len(stats['missed']), np.sqrt(np.mean(Derr[output[:,0] > 60]**2)))
+    
+    
 if __name__ == '__main__':
     testNMPC()
\ No newline at end of file
@@ -0,0 +1,384 @@
+""" Parallel Monte Carlo campaigns over the uncertainty space """
+
+import multiprocessing as mp
+import numpy as np
+import hashlib
+import os
+
+
+_worker = {}    # The state of the campaign within each worker process, built once per process by the pool initializer
+
+
+def _initWorker(initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+
+def _call(task):
+    i, sample, seed = task
+    np.random.seed(seed)
+    return i, _worker['fun'](sample)
+
+def _setFunction(fun):
+    _worker['fun'] = fun
+
+
+def parallelMap(fun, samples, workers=None, chunksize=None, seed=0, initializer=None, initargs=(), callback=None, collect=True, indices=None, output=False):
+    '''
+        Evaluates fun(sample) for each sample (an iterable of samples, e.g. the columns of a chaospy sample matrix) over a pool of worker processes.
+
+        Samples are dispatched with imap_unordered in chunks of chunksize so that workers finishing short trajectories are handed more work, and
+        the results are returned in the order of the samples. Each evaluation is preceded by seeding numpy's global generator with a per-sample
+        seed drawn from seed, so results do not depend on which worker ran a sample. initializer(*initargs) is called once in each worker, and
+        callback(i, result) in the calling process as each result arrives. workers=1 evaluates the samples serially without a pool.
+        With collect=False the results are only passed to callback, e.g. a ResultStore, and None is returned so memory does not grow with n.
+        If indices is given only those samples are evaluated, with the same seeds as in a complete run, and the others' results are None.
+
+        fun, initializer and initargs are inherited by the workers when processes are forked, but must be picklable on platforms that spawn them.
+    '''
+
+    samples = list(samples)
+    seeds = np.random.RandomState(seed).randint(0, 2**31-1, size=len(samples))
+    if indices is None:
+        indices = range(len(samples))
+    tasks = [(i, samples[i], seeds[i]) for i in indices]
+    n = len(tasks)
+    if workers is None:
+        workers = mp.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, n//(8*workers))
+
+    results = [None]*len(samples)
+    if workers == 1:
+        _initWorker(initializer, initargs)
+        _setFunction(fun)
+        iterator = (_call(task) for task in tasks)
+        pool = None
+    else:
+        _setFunction(fun)                                                  # Inherited by forked workers
+        pool = mp.Pool(workers, initializer=_initWorker, initargs=(initializer, initargs))
+        iterator = pool.imap_unordered(_call, tasks, chunksize)
+
+    try:
+        for count, (i, result) in enumerate(iterator):
+            if collect:
+                results[i] = result
+            if callback is not None:
+                callback(i, result)
+            if output and not (count+1) % max(1, n//10):
+                print "{} of {} samples complete".format(count+1, n)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if collect:
+        return results
+
+
+class Campaign(object):
+    '''
+        Defines a Monte Carlo campaign of a guided simulation over the parametric uncertainty.
+
+        Inputs:
+            simulation   - a factory returning a Simulation, e.g. lambda: Simulation(cycle=Cycle(1), output=False, **EntrySim()), called once per worker process
+            controllers  - the controllers in each phase, as passed to Simulation.run
+            InitialState - the state from which every sample is run
+            workers      - the number of worker processes, all available cpus by default
+            chunksize    - the number of samples dispatched to a worker at a time
+            seed         - seeds the per-sample seeds of numpy's global generator
+
+        Methods:
+            run - runs the simulation for each sample, returning the list of outputs in sample order
+
+        Members:
+            samples - the (4,n) sample matrix of the most recent run
+            outputs - the outputs of the most recent run
+    '''
+
+    def __init__(self, simulation, controllers, InitialState, workers=None, chunksize=None, seed=0, AeroRatios=(1,1), output=True):
+        self.simulation = simulation
+        self.controllers = controllers
+        self.InitialState = np.asarray(InitialState)
+        self.workers = workers
+        self.chunksize = chunksize
+        self.seed = seed
+        self.AeroRatios = AeroRatios
+        self.output = output
+
+        self.samples = None
+        self.outputs = None
+
+    def run(self, samples, n=None, rule='R', callback=None, store=None, config=None):
+        ''' Runs the campaign for a chaospy distribution, from which n samples are drawn using rule, or for a (4,n) sample matrix.
+            If a ResultStore is given each output is written to it as it arrives instead of being kept in outputs, and the store is returned.
+            A store from an interrupted run is resumed by running only its missing samples, reusing its samples in place of drawing new ones.
+            The store is bound to the samples and to config, any description of the setup that should invalidate earlier results when changed,
+            which is combined with the initial state, aerodynamic ratios and seed of the campaign.
+        '''
+
+        if hasattr(samples, 'sample'):
+            if store is not None and store.samples is not None and store.samples.shape[1] == n:
+                samples = store.samples
+            else:
+                samples = samples.sample(n, rule)
+        self.samples = np.atleast_2d(samples)
+
+        indices = None
+        if store is not None:
+            store.bind(self.samples, (config, self.InitialState.tolist(), self.AeroRatios, self.seed))
+            indices = store.missing()
+            sink = callback
+            callback = lambda i, result: (store.append(i, result), sink is not None and sink(i, result))
+        if self.output:
+            print "Running {} of {} samples".format(self.samples.shape[1] if indices is None else len(indices), self.samples.shape[1])
+        self.outputs = parallelMap(_simulate, self.samples.T, workers=self.workers, chunksize=self.chunksize, seed=self.seed,
+                                   initializer=_initCampaign, initargs=(self,), callback=callback, collect=store is None, indices=indices,
+                                   output=self.output)
+        if store is not None:
+            store.flush()
+            return store
+        return self.outputs
+
+
+class SimulationPool(object):
+    '''
+        A pool of worker processes, each holding its own Simulation, that evaluates cost(x, sim, *args) for many x in parallel.
+
+        The pool is map-like so that it can be passed as the workers argument of differential_evolution together with objective as the
+        function minimized, e.g. differential_evolution(pool.objective, bounds, workers=pool, updating='deferred'), evaluating each
+        generation over the pool. The simulation factory is called once in each worker when the pool starts, so only the candidates are
+        sent with each generation. cost, simulation and args are inherited by the workers when processes are forked, but must be
+        picklable on platforms that spawn them. The pool persists until closed, and may be used as a context manager.
+
+        Members:
+            objective - the picklable function of x evaluated by the workers
+            times     - the wall clock duration of each map
+    '''
+
+    def __init__(self, cost, simulation, args=(), workers=None, chunksize=None):
+        if workers is None:
+            workers = mp.cpu_count()
+        self.workers = workers
+        self.chunksize = chunksize
+        self.objective = _objective
+        self.times = []
+        self.pool = mp.Pool(workers, initializer=_initWorker, initargs=(_initObjective, (cost, simulation, args)))
+
+    def __call__(self, fun, iterable):
+        from time import time
+
+        candidates = list(iterable)
+        chunksize = self.chunksize or max(1, len(candidates)//(4*self.workers))
+        t0 = time()
+        results = self.pool.map(fun, candidates, chunksize)
+        self.times.append(time()-t0)
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultStore(object):
+    '''
+        Streams per-sample results, 2-D arrays whose number of rows may differ between samples, to a directory of compressed chunks.
+
+        Results are buffered and written every chunk samples as chunk-#####.npz, holding the rows of the buffered samples stacked vertically.
+        Each chunk is written under a temporary name and renamed once complete, and only then are its samples appended to index.txt, one line of
+        "sample chunk start rows" per sample. A crash therefore loses at most the buffered samples, and reopening the directory continues it.
+
+        A store may be bound to the sample matrix and configuration of a campaign, which saves the samples as samples.npy and the sha1 of the
+        samples and configuration in manifest.txt. Binding an existing store to different samples or configuration raises a ValueError rather
+        than mixing results, and missing() returns the samples that remain to be run when resuming.
+
+        Methods:
+            bind(samples, config) - binds the store to a (d,n) sample matrix and configuration, verifying those of earlier results
+            missing           - returns the indices of the bound samples that have not been stored
+            append(i, result) - stores the result of sample i, also available by calling the store so it can be passed as a callback
+            flush             - writes any buffered results
+            load(i)           - returns the result of sample i
+            tensor            - returns every result in sample order, as a 3-D array if they have equal lengths and an object array otherwise
+            savemat(filename) - exports the results and optionally the samples as a .mat file for visualize.m
+
+        Members:
+            path    - the directory holding the chunks and index
+            indices - the sorted indices of the samples stored so far
+            samples - the bound sample matrix, or None
+    '''
+
+    def __init__(self, path, chunk=100):
+        self.path = path
+        self.chunk = chunk
+        self.__index = {}           # sample -> (chunk, start row, number of rows)
+        self.__buffer = []
+        self.__nChunks = 0
+        self.__cache = (None, None) # The most recently loaded chunk number and its data
+        self.samples = None
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, 'samples.npy')):
+            self.samples = np.load(os.path.join(path, 'samples.npy'))
+        indexFile = os.path.join(path, 'index.txt')
+        if os.path.exists(indexFile):
+            for line in open(indexFile):
+                i, c, start, rows = [int(v) for v in line.split()]
+                self.__index[i] = (c, start, rows)
+                self.__nChunks = max(self.__nChunks, c+1)
+
+    def bind(self, samples, config=None):
+        samples = np.atleast_2d(samples)
+        key = fingerprint(samples, config)
+        manifest = os.path.join(self.path, 'manifest.txt')
+        if os.path.exists(manifest):
+            if open(manifest).read().strip() != key:
+                raise ValueError("The results in {} were computed for different samples or configuration, use a new directory.".format(self.path))
+        else:
+            if len(self):
+                raise ValueError("The results in {} cannot be verified against the samples and configuration.".format(self.path))
+            np.save(os.path.join(self.path, 'samples.npy'), samples)
+            with open(manifest, 'w') as f:
+                f.write(key+'\n')
+        self.samples = samples
+
+    def missing(self):
+        return [i for i in range(self.samples.shape[1]) if i not in self]
+
+    def __call__(self, i, result):
+        self.append(i, result)
+
+    def append(self, i, result):
+        self.__buffer.append((i, np.atleast_2d(result)))
+        if len(self.__buffer) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self.__buffer:
+            return
+        c = self.__nChunks
+        name = self.__chunkFile(c)
+        temp = name[:-4] + '.tmp.npz'                                       # savez appends .npz to names without it
+        np.savez_compressed(temp, data=np.vstack([result for _,result in self.__buffer]))
+        os.rename(temp, name)
+
+        lines = []
+        start = 0
+        for i, result in self.__buffer:
+            self.__index[i] = (c, start, result.shape[0])
+            lines.append('{} {} {} {}\n'.format(i, c, start, result.shape[0]))
+            start += result.shape[0]
+        with open(os.path.join(self.path, 'index.txt'), 'a') as index:
+            index.writelines(lines)
+            index.flush()
+            os.fsync(index.fileno())
+
+        self.__nChunks += 1
+        self.__buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, i):
+        return i in self.__index or any(j == i for j,_ in self.__buffer)
+
+    def __len__(self):
+        return len(self.__index) + len(self.__buffer)
+
+    @property
+    def indices(self):
+        return sorted(set(self.__index.keys()) | set(j for j,_ in self.__buffer))
+
+    def load(self, i):
+        for j, result in self.__buffer:
+            if j == i:
+                return result
+        c, start, rows = self.__index[i]
+        if self.__cache[0] != c:
+            with np.load(self.__chunkFile(c)) as data:
+                self.__cache = (c, data['data'])
+        return self.__cache[1][start:start+rows]
+
+    def tensor(self):
+        indices = self.indices
+        byChunk = sorted(indices, key=lambda i: self.__index[i][0] if i in self.__index else -1)   # So that each chunk is read once
+        loaded = dict((i, self.load(i)) for i in byChunk)
+        results = [loaded[i] for i in indices]
+        if len(set(result.shape for result in results)) == 1:
+            return np.array(results)
+        tensor = np.empty(len(results), dtype=object)
+        tensor[:] = results
+        return tensor
+
+    def savemat(self, filename, samples=None):
+        from scipy.io import savemat
+        data = {'states': self.tensor(), 'index': np.array(self.indices)}
+        if samples is not None:
+            data['samples'] = samples
+        savemat(filename, data, do_compression=True)
+
+    def __chunkFile(self, c):
+        return os.path.join(self.path, 'chunk-{:05d}.npz'.format(c))
+
+
+def fingerprint(samples, config=None):
+    ''' Returns the sha1 hex digest of a sample matrix and a configuration whose repr is deterministic, e.g. a tuple of numbers and strings. '''
+
+    samples = np.ascontiguousarray(samples, dtype=float)
+    sha = hashlib.sha1(samples.tobytes())
+    sha.update(repr(samples.shape))
+    sha.update(repr(config))
+    return sha.hexdigest()
+
+
+def _initCampaign(campaign):
+    _worker['sim'] = campaign.simulation()
+    _worker['campaign'] = campaign
+
+def _simulate(sample):
+    campaign = _worker['campaign']
+    return _worker['sim'].run(campaign.InitialState, campaign.controllers, sample, AeroRatios=campaign.AeroRatios)
+
+def _initObjective(cost, simulation, args):
+    _worker['sim'] = simulation()
+    _worker['objective'] = (cost, args)
+
+def _objective(x):
+    cost, args = _worker['objective']
+    return cost(x, _worker['sim'], *args)
+
+
+def testCampaign(n=100, workers=4):
+    ''' Runs a dispersed open loop entry serially and in parallel, and checks the results agree. '''
+    from time import time
+    from Simulation import Simulation, Cycle, EntrySim, NominalEntry
+    from Uncertainty import getUncertainty
+
+    simulation = lambda: Simulation(cycle=Cycle(1), output=False, **EntrySim())
+    x0, bankProfile = NominalEntry()
+    samples = getUncertainty()['parametric'].sample(n)
+
+    timing, outputs = [], []
+    for w in (1, workers):
+        mc = Campaign(simulation, [bankProfile], x0, workers=w, output=False)
+        t0 = time()
+        outputs.append(mc.run(samples))
+        timing.append(time()-t0)
+
+    print "Serial campaign: {:.2f} s, {} workers: {:.2f} s".format(timing[0], workers, timing[1])
+    print "Maximum difference between serial and parallel outputs: {}".format(max(np.abs(a-b).max() for a,b in zip(*outputs)))
+
+
+if __name__ == '__main__':
+    testCampaign()
@@ -4,6 +4,8 @@ import chaospy as cp
 from EntryEquations import Entry
 from Triggers import DeployParachute, findTriggerPoint
 from Target import Target
+from MPC import trilinear
+from Uncertainty import UQContext, getContext
 from scipy.integrate import odeint
 # from Utils.redirect import stdout_redirected
 from functools import partial
@@ -13,32 +15,12 @@ def HEPBankReduced(T,t1,t2,minBank = np.radians(15.), maxBank = np.radians(85.))
     maxRate = np.radians(20.)
     ti1 = t1 + 2*(maxBank)/maxRate
     ti2 = t2 + (maxBank+minBank)/maxRate
-    isScalar = False
-    bank = []
-    if isinstance(T,(float,int,np.float32,np.float64)):
-        T = [T]
-        isScalar = True
-
-    for t in T:
-
-        if t <= t1:
-            bank.append(maxBank)
-        elif t >= t1 and t <= ti1:
-            bank.append(maxBank-maxRate*(t-t1))
-        elif t >= ti1 and t <= t2:
-            bank.append(-maxBank)
-        elif t >= t2 and t <= ti2:
-            bank.append(-maxBank + maxRate*(t-t2))
-        else:
-            bank.append(minBank)
-    if isScalar:
-        try:
-            return bank[0]
-        except:
-            print "Bank angle comp failed"
-            return -1.
-    else:
-        return bank
+    t = np.asarray(T)
+
+    bank = np.select([t <= t1, t <= ti1, t <= t2, t <= ti2],
+                     [maxBank, maxBank-maxRate*(t-t1), -maxBank, -maxBank + maxRate*(t-t2)],
+                     minBank)
+    return _scalar(bank)
 
         
 def HEPBankReducedSmooth(T,t1,t2,minBank = np.radians(15.), maxBank = np.radians(85.)):
@@ -49,49 +31,23 @@ def HEPBankReducedSmooth(T,t1,t2,minBank = np.radians(15.), maxBank = np.radians
     t1a = t1+dt                                             # Acceleration phase
     t1v = t1 + 2*maxBank/maxRate                            # Max velocity phase
     t1d = t1v + dt                                          # Max deceleration phase    #Future: check that this is less than t2
-    if t1d >= t2:
-        noMax1 = True
-    else:
-        noMax1 = False
     
     t2a = t2 + dt
     t2v = t2 + (minBank+maxBank)/maxRate
     t2d = t2v + dt
-    
-    isScalar = False
-    bank = []
-    if isinstance(T,(float,int,np.float32,np.float64)):
-        T = [T]
-        isScalar = True
-        
-    for t in T:
-        if t <= t1:
-            bank.append(maxBank)
-        elif t > t1 and t <= t1a: #Negative acceleration phase
-            bank.append(maxBank-0.5*maxAcc*(t-t1)**2)
-        elif t > t1a and t <= t1v: #Max velocity phase
-            bank.append(maxBank-dbank-maxRate*(t-t1a))
-        elif t > t1v and t <= t1d:
-            bank.append(dbank-maxBank - maxRate*(t-t1v) + 0.5*maxAcc*(t-t1v)**2 )
-        elif t > t1d and t <= t2:
-            bank.append(-maxBank)
-        elif t > t2 and t <= t2a:
-            bank.append(-maxBank + 0.5*maxAcc*(t-t2)**2)
-        elif t > t2a and t <= t2v:
-            bank.append(dbank-maxBank + maxRate*(t-t2a))
-        elif t > t2v and t <= t2d:
-            bank.append(minBank-dbank + maxRate*(t-t2v) - 0.5*maxAcc*(t-t2v)**2)
-        else:
-            bank.append(minBank)
-        
-    if isScalar:
-        try:
-            return bank[0]
-        except:
-            print "Bank angle comp failed"
-            return -1.
-    else:
-        return bank
+    t = np.asarray(T)
+    
+    bank = np.select([t <= t1, t <= t1a, t <= t1v, t <= t1d, t <= t2, t <= t2a, t <= t2v, t <= t2d],
+                     [maxBank,
+                      maxBank-0.5*maxAcc*(t-t1)**2,                                  # Negative acceleration phase
+                      maxBank-dbank-maxRate*(t-t1a),                                 # Max velocity phase
+                      dbank-maxBank - maxRate*(t-t1v) + 0.5*maxAcc*(t-t1v)**2,
+                      -maxBank,
+                      -maxBank + 0.5*maxAcc*(t-t2)**2,
+                      dbank-maxBank + maxRate*(t-t2a),
+                      minBank-dbank + maxRate*(t-t2v) - 0.5*maxAcc*(t-t2v)**2],
+                     minBank)
+    return _scalar(bank)
         
 def HEPBank(T,t1,t2,t3,minBank = np.radians(15.), maxBank = np.radians(85.)):
 
@@ -99,42 +55,35 @@ def HEPBank(T,t1,t2,t3,minBank = np.radians(15.), maxBank = np.radians(85.)):
     ti1 = t1 + (maxBank+minBank)/maxRate
     ti2 = t2 + 2*(maxBank)/maxRate
     ti3 = t3 + (maxBank+minBank)/maxRate
-    isScalar = False
-    bank = []
-    if isinstance(T,(float,int,np.float32,np.float64)):
-        T = [T]
-        isScalar = True
-
-    for t in T:
-        if t < t1 and t >= 0:
-            bank.append(-minBank) 
-        elif t >= t1 and t <= ti1:
-            bank.append(-minBank+maxRate*(t-t1))
-        elif t >= ti1 and t <= t2:
-            bank.append(maxBank)
-        elif t >= t2 and t <= ti2:
-            bank.append(maxBank-maxRate*(t-t2))
-        elif t >= ti2 and t <= t3:
-            bank.append(-maxBank)
-        elif t >= t3 and t <= ti3:
-            bank.append(-maxBank + maxRate*(t-t3))
-        else:
-            bank.append(minBank)
-    if isScalar:
-        try:
-            return bank[0]
-        except:
-            print "Bank angle comp failed"
-            return -1.
-    else:
+    t = np.asarray(T)
+
+    bank = np.select([(t < t1) & (t >= 0), (t >= t1) & (t <= ti1), (t >= ti1) & (t <= t2), (t >= t2) & (t <= ti2), (t >= ti2) & (t <= t3), (t >= t3) & (t <= ti3)],
+                     [-minBank, -minBank+maxRate*(t-t1), maxBank, maxBank-maxRate*(t-t2), -maxBank, -maxBank + maxRate*(t-t3)],
+                     minBank)
+    return _scalar(bank)
+
+def HEPBankBatch(T, parameters, profile=HEPBank, **kwargs):
+    """ Evaluates a bank profile on the (M,) times T for each row of the (K, n_switch) switching times, e.g. a differential evolution population
+        or the transpose of a set of quadrature nodes, returning a (K, M) array. Keyword arguments such as minBank are passed to the profile.
+    """
+    T = np.atleast_1d(np.asarray(T, dtype=float))
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    return profile(T[None,:], *parameters.T[:,:,None], **kwargs)
+    
+def _scalar(bank):
+    """ Returns a float for the bank angle at a single time, and arrays unchanged. """
+    if np.ndim(bank):
         return bank
+    return float(bank)
+
+PENALTY = 1e7      # The least cost of a candidate that is rejected or aborted rather than simulated to its trigger
 
 def checkFeasibility(T,sign=-1):
     
     sig = sign*np.diff(T) #np.array([T[0]-T[1],T[1]-T[2]])
     cost = (sum(sig+np.abs(sig)) + sum(abs(T)-T))*1e5
     if cost:
-        return max(cost,1e7)
+        return max(cost,PENALTY)
     else:
         return 0
         
@@ -215,18 +164,23 @@ def OptimizeSmooth(x0):
 
     return (lambda x,t: bankFun(getIV(x,t),*sol.x)), sol
 
-def OptimizeSRP():
-    """ Not named very well. Computes the three switch bank profile that delivers the entry vehicle to a prescribed altitude, downrange, crossrange at a given velocity trigger point. """
+def OptimizeSRP(workers=1, method='evolve'):
+    """ Not named very well. Computes the three switch bank profile that delivers the entry vehicle to a prescribed altitude, downrange, crossrange at a given velocity trigger point.
+        The method is either 'evolve' for differential evolution over full simulations or 'surrogate' for a response surface refined by simulation.
+    """
     
-    from scipy.optimize import differential_evolution, minimize
-    from Simulation import Simulation, Cycle, EntrySim
+    from scipy.optimize import minimize
 
-    sim = Simulation(cycle=Cycle(1),output=False,**EntrySim())
+    simulation = EntrySimulation
+    sim = simulation()
 
     if 1:
         # bounds = [(0,250),(100,350)]
         bounds = [(0,250),(100,400),(100,450)]
-        sol = differential_evolution(SRPCost,args = (sim,), bounds=bounds, tol=1e-2, disp=True, polish=False)
+        if method == 'surrogate':
+            sol = surrogate(SRPCost, bounds, simulation, workers=workers)
+        else:
+            sol = evolve(SRPCost, bounds, simulation, workers=workers, tol=1e-2, disp=True, polish=False)
     else:
         sol = minimize(SRPCost,[ 165.4159422 ,  308.86420218,  399.53393904], args=(sim,), method='Nelder-Mead', tol=1e-5, options={'disp':True})
         
@@ -244,9 +198,143 @@ def OptimizeSRP():
     
     return sim,sol # Optimal: 1000 km DR, 0 CR, 5 km altitude np.array([ 165.4159422 ,  308.86420218,  399.53393904])
     
-def SRPCost(p, sim, sample=None):
+def EntrySimulation():
+    """ Returns a new open loop entry Simulation. Each must be built from a fresh EntrySim configuration, since Simulation appends to its list of states. """
+    from Simulation import Simulation, Cycle, EntrySim
+    
+    return Simulation(cycle=Cycle(1), output=False, **EntrySim())
+    
+def evolve(cost, bounds, simulation, args=(), workers=1, output=True, **kwargs):
+    """ Minimizes cost(p, sim, *args) by differential evolution, where sim is built by the factory simulation, reporting the time taken by each generation.
+    
+        With more than one worker, or workers=None for all available cpus, each generation is evaluated over a MonteCarlo.SimulationPool
+        holding one simulation per worker. The population is then updated once per generation rather than after every candidate, so the
+        search differs from the serial one. Keyword arguments are passed to differential_evolution. The generation times are returned
+        in the solution's generation_times.
+    """
+    from scipy.optimize import differential_evolution
+    from MonteCarlo import SimulationPool
+    
+    timer = GenerationTimer(output)
+    if workers == 1:
+        sol = differential_evolution(cost, bounds, args=(simulation(),)+tuple(args), callback=timer, **kwargs)
+    else:
+        with SimulationPool(cost, simulation, args, workers) as pool:
+            sol = differential_evolution(pool.objective, bounds, workers=pool, updating='deferred', callback=timer, **kwargs)
+    sol.generation_times = timer.times
+    if output:
+        print "{} generations in {:.1f} s, {:.2f} s per generation".format(len(timer.times), sum(timer.times), np.mean(timer.times) if timer.times else np.nan)
+    return sol
+    
+    
+def surrogate(cost, bounds, simulation, args=(), workers=1, n=None, iterations=30, refine=6, trust=0.5, xtol=1e-3, penalty=PENALTY, output=True):
+    """ Minimizes cost(p, sim, *args) over the box bounds with a radial basis function response surface in place of most simulations.
+    
+        The cost is first simulated on n points of a Sobol design over the bounds, 20 per dimension by default. Each iteration then fits a
+        thin plate spline to the squares of every cost computed so far, since the planner costs are norms of a miss whose kink at zero the
+        spline cannot follow. It minimizes the spline by differential evolution within a trust region of half width trust (a fraction of the
+        bounds) about the best point simulated, and simulates the spline's optimum and refine-1 points drawn uniformly within half the trust
+        region. The trust region halves after an iteration that does not improve the best cost, and the search stops when it falls below
+        xtol or after the given number of iterations. Costs above the median of those below penalty, including penalties from checkFeasibility
+        or RangeAbort, are fitted as that median so that poor candidates do not dominate the surface near the optimum. The simulations of a design or iteration are evaluated over a
+        MonteCarlo.SimulationPool when workers is not 1.
+        
+        The solution's X and J hold every point simulated and its cost, and nfev the number of simulations.
+    """
+    from scipy.optimize import differential_evolution, OptimizeResult
+    from scipy.interpolate import Rbf
+    from MonteCarlo import SimulationPool
+    from time import time
+    
+    bounds = np.asarray(bounds, dtype=float)
+    lower, width = bounds[:,0], bounds[:,1]-bounds[:,0]
+    dim = len(bounds)
+    if n is None:
+        n = 20*dim
+    design = cp.J(*[cp.Uniform(0, 1) for _ in bounds]).sample(n, 'S')
+    X = lower + np.reshape(design.T, (n, dim))*width
+    
+    pool = None if workers == 1 else SimulationPool(cost, simulation, args, workers)
+    if pool is None:
+        sim = simulation()
+        evaluate = lambda points: [cost(x, sim, *args) for x in points]
+    else:
+        evaluate = lambda points: pool(pool.objective, points)
+    
+    try:
+        t0 = time()
+        J = np.array(evaluate(X), dtype=float)
+        best = J.argmin()
+        if output:
+            print "Initial design: {} simulations in {:.1f} s, best cost {}".format(n, time()-t0, J[best])
+        
+        nit = 0
+        while nit < iterations and trust >= xtol:
+            nit += 1
+            t0 = time()
+            U, unique = np.unique(np.round((X-lower)/width, 12), axis=0, return_index=True)      # Repeated points make the spline singular
+            feasible = J[J < penalty]
+            values = np.minimum(J[unique], np.median(feasible) if feasible.size else penalty)
+            model = Rbf(*(tuple(U.T) + (values**2,)), function='thin_plate')
+            incumbent = (X[best]-lower)/width
+            region = zip(np.maximum(incumbent-trust, 0), np.minimum(incumbent+trust, 1))
+            fit = differential_evolution(lambda u: float(model(*u)), region, tol=1e-6, polish=True)
+            
+            centre = np.clip(fit.x, 0, 1)
+            local = np.clip(incumbent + 0.5*trust*np.random.uniform(-1, 1, size=(refine-1, dim)), 0, 1)
+            points = lower + np.vstack((centre, local))*width
+            values = np.array(evaluate(points), dtype=float)
+            X = np.vstack((X, points))
+            J = np.concatenate((J, values))
+            
+            if values.min() < J[best]:
+                best = J.argmin()
+            else:
+                trust /= 2.
+            if output:
+                print "Iteration {}: surrogate {:.4g}, simulated {:.4g}, best {:.4g}, trust region {:.3g} ({:.1f} s)".format(nit, np.sqrt(max(fit.fun, 0)), values[0], J[best], trust, time()-t0)
+    finally:
+        if pool is not None:
+            pool.close()
+    
+    return OptimizeResult(x=X[best], fun=J[best], nfev=len(J), nit=nit, X=X, J=J)
+    
+    
+class GenerationTimer(object):
+    """ A differential evolution callback recording the wall clock time of each generation. The first includes the initial population. """
+    
+    def __init__(self, output=True):
+        from time import time
+        self.clock = time
+        self.output = output
+        self.times = []
+        self.last = time()
+        
+    def __call__(self, xk, convergence=None):
+        now = self.clock()
+        self.times.append(now-self.last)
+        self.last = now
+        if self.output:
+            print "Generation {}: {:.2f} s".format(len(self.times), self.times[-1])
+    
+    
+def RangeAbort(h_min=5, range_min=200, penalty=PENALTY):
+    """ Returns an abort predicate for Simulation.run that ends trajectories below h_min km of altitude with more than range_min km still to go.
+        Their cost is penalty plus the range to go in km, so that like infeasible candidates they are recognized as penalized by surrogate.
+        The SRP trajectories it catches only fall below the target altitude in the last few percent of their flight, so it saves little
+        time, and it replaces their true costs, so it is not used by SRPCost unless passed as its abort.
+    """
+    def abort(altitude, rangeToGo):
+        if altitude < h_min*1e3 and rangeToGo > range_min*1e3:
+            return penalty + rangeToGo/1e3
+    abort.requires = ('altitude', 'rangeToGo')
+    return abort
+    
+def SRPCost(p, sim, sample=None, v0=5505.0, gamma0=np.radians(-14.15), dr_target=1000, abort=None):
+    """ The altitude and range miss at the velocity trigger of the HEP bank profile with switching times p, from an entry at velocity v0 and flight path angle gamma0, for a downrange target in km. 
+        Infeasible switching orders are penalized by checkFeasibility without simulating them, and trajectories ended early by abort, if given, return its penalty.
+    """
 
-    dr_target = 1000
     cr_target = 0
     h_target = 5
 
@@ -257,12 +345,14 @@ def SRPCost(p, sim, sample=None):
     
     # bankProfile = lambda **d: HEPBankReducedSmooth(d['time'],*p)
     bankProfile = lambda **d: HEPBank(d['time'],*p)
+    bankProfile.requires = ('time',)
     
-    r0, theta0, phi0, v0, gamma0, psi0,s0 = (3540.0e3, np.radians(-90.07), np.radians(-43.90),
-                                             5505.0,   np.radians(-14.15), np.radians(4.99),   dr_target*1e3)
+    r0, theta0, phi0, psi0, s0 = (3540.0e3, np.radians(-90.07), np.radians(-43.90), np.radians(4.99), dr_target*1e3)
                                              
     x0 = np.array([r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0])
-    output = sim.run(x0,[bankProfile],sample)
+    output = sim.run(x0,[bankProfile],sample,TerminalOnly=True,Abort=abort)
+    if sim.aborted is not None:
+        return sim.aborted
 
     Xf = output[-1,:]
     # data = np.c_[self.times, energy, bank, h,   r,      theta,       phi,      v,         gamma, psi,       range,     L,      D]
@@ -275,18 +365,22 @@ def SRPCost(p, sim, sample=None):
 
     return J
 
-def OptimizeSRPRS():
+def OptimizeSRPRS(workers=1, method='evolve'):
+    """ Computes the three switch bank profile minimizing the expected SRPCost over the parametric uncertainty, by either method of OptimizeSRP. """
     from Uncertainty import getUncertainty
-    from Simulation import Simulation, Cycle, EntrySim
-    from scipy.optimize import differential_evolution, minimize
+    from scipy.optimize import minimize
     
-    sim = Simulation(cycle=Cycle(1),output=False,**EntrySim()) 
+    simulation = EntrySimulation
+    sim = simulation()
     perturb = getUncertainty()['parametric']
     if 0:
         sol = minimize(SRPCostRS, [ 165.4159422 ,  308.86420218,  399.53393904], args=(sim, perturb), method='Nelder-Mead', tol=1e-2, options={'disp':True})
     else:
         bounds = [(0,250),(100,400),(250,500)]
-        sol = differential_evolution(SRPCostRS, args = (sim, perturb), bounds=bounds, tol=1e-3, disp=True, polish=False)
+        if method == 'surrogate':
+            sol = surrogate(SRPCostRS, bounds, simulation, args=(getContext(perturb),), workers=workers)
+        else:
+            sol = evolve(SRPCostRS, bounds, simulation, args=(getContext(perturb),), workers=workers, tol=1e-3, disp=True, polish=False)
     
     print sol.x
     
@@ -306,15 +400,117 @@ def OptimizeSRPRS():
     # [ 162.4368125   294.35875742  461.31910219] with differential evolution, each with a cost of 43.8 roughly. Nominal solution has a cost of 44.6
     
 def SRPCostRS(p, sim, pdf):
-
-    polynomials = cp.orth_ttr(order=2, dist=pdf)
-    samples,weights = cp.generate_quadrature(order=2, domain=pdf, rule="Gaussian")
-    stateTensor = [SRPCost(p, sim, s) for s in samples.T]
+    """ The expected SRPCost over the distribution pdf, or over the quadrature of a UQContext, from its order 2 polynomial chaos expansion. """
+    
+    context = pdf if isinstance(pdf, UQContext) else getContext(pdf)
+    stateTensor = [SRPCost(p, sim, s) for s in context.nodes.T]
+    if max(stateTensor) >= PENALTY:                 # A candidate penalized at any node is penalized, rather than averaged into a finite cliff
+        return max(stateTensor)
     # stateTensor = pool.map(OptCost,samples.T)
-    PCE = cp.fit_quadrature(polynomials,samples,weights,stateTensor)
     
-    # print "PCE Expectation: {} ".format(cp.E(poly=PCE,dist=pdf))
-    return cp.E(poly=PCE,dist=pdf)
+    # print "PCE Expectation: {} ".format(context.fit_and_expect(stateTensor))
+    return context.fit_and_expect(stateTensor)
+    
+    
+class SwitchingTable(object):
+    '''
+        The optimal HEP switching times [t1, t2, t3] tabulated by buildSwitchingTable over a grid of entry velocity, flight path angle and
+        downrange target, so that replanning for a new entry interface state is a lookup plus at most a short local polish.
+        
+        Methods:
+            lookup(v0, gamma0, dr_target)       - interpolates the switching times, clamping the entry condition to the grid
+            plan(v0, gamma0, dr_target, sim)    - polishes the interpolated switching times by Nelder-Mead on SRPCost
+            save(filename)                      - saves the table, which SwitchingTable.load(filename) restores
+            
+        Members:
+            axes  - the velocity (m/s), flight path angle (rad) and downrange (km) grids
+            table - (nv, ngamma, nrange, 3) optimal switching times
+            cost  - (nv, ngamma, nrange) SRPCost of the tabulated switching times
+    '''
+    
+    def __init__(self, axes, table, cost=None):
+        self.axes = [np.asarray(axis, dtype=float) for axis in axes]
+        self.table = np.asarray(table, dtype=float)
+        self.cost = None if cost is None else np.asarray(cost, dtype=float)
+        
+    def lookup(self, v0, gamma0, dr_target):
+        """ Trilinear interpolation of the switching times. """
+        
+        return trilinear(self.axes, self.table, (v0, gamma0, dr_target))
+        
+    def plan(self, v0, gamma0, dr_target, sim=None, maxfev=40):
+        """ Returns the interpolated switching times polished by at most maxfev simulations with sim, or unpolished if sim is None, and their cost. """
+        from scipy.optimize import minimize
+        
+        guess = self.lookup(v0, gamma0, dr_target)
+        if sim is None:
+            return guess, None
+        sol = minimize(SRPCost, guess, args=(sim, None, v0, gamma0, dr_target), method='Nelder-Mead', options={'maxfev':maxfev, 'xatol':1e-2, 'fatol':1e-2})
+        return sol.x, sol.fun
+        
+    def save(self, filename):
+        cost = np.full(self.table.shape[:-1], np.nan) if self.cost is None else self.cost         # So that the file holds no object arrays
+        np.savez(filename, velocity=self.axes[0], fpa=self.axes[1], range=self.axes[2], table=self.table, cost=cost)
+        
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        cost = data['cost']
+        return SwitchingTable([data['velocity'], data['fpa'], data['range']], data['table'], None if np.isnan(cost).all() else cost)
+        
+        
+def buildSwitchingTable(velocity=np.linspace(5305,5705,5), fpa=np.radians(np.linspace(-16.15,-12.15,5)), dr_target=np.linspace(900,1100,5), 
+                        method='surrogate', bounds=[(0,250),(100,400),(100,450)], workers=None, output=True):
+    ''' Solves OptimizeSRP's problem at every entry velocity, flight path angle and downrange target of a grid over a process pool, returning a SwitchingTable.
+        Each grid point is optimized serially within a worker, by the surrogate search or by differential evolution with method='evolve'.
+    '''
+    from MonteCarlo import parallelMap
+    
+    simulation = EntrySimulation
+    points = [(v, gamma, dr) for v in velocity for gamma in fpa for dr in dr_target]
+    
+    def solve(point):
+        if method == 'surrogate':
+            sol = surrogate(SRPCost, bounds, simulation, args=(None,)+point, output=False)
+        else:
+            sol = evolve(SRPCost, bounds, simulation, args=(None,)+point, output=False, tol=1e-2, polish=False)
+        return np.append(sol.x, sol.fun)
+        
+    solutions = np.reshape(parallelMap(solve, points, workers=workers, output=output), (len(velocity), len(fpa), len(dr_target), len(bounds)+1))
+    return SwitchingTable([velocity, fpa, dr_target], solutions[...,:-1], solutions[...,-1])
+    
+    
+def testSwitchingTable(table=None, n=3):
+    ''' Builds a 2x2x2 table unless one is given, checks that it survives saving and loading, and compares its interpolated and polished
+        switching times against full optimizations at random entry conditions within the grid. '''
+    from time import time
+    import os, tempfile
+    
+    if table is None:
+        t0 = time()
+        table = buildSwitchingTable(velocity=[5405,5605], fpa=np.radians([-15.15,-13.15]), dr_target=[950,1050], output=False)
+        print "Built a {} table in {:.1f} s, costs at the grid points {}".format('x'.join(str(len(axis)) for axis in table.axes), time()-t0, np.round(table.cost.flatten(), 2))
+        
+    filename = os.path.join(tempfile.mkdtemp(), 'table.npz')
+    table.save(filename)
+    loaded = SwitchingTable.load(filename)
+    assert np.array_equal(loaded.table, table.table) and all(np.array_equal(a, b) for a,b in zip(loaded.axes, table.axes))
+    
+    sim = EntrySimulation()
+    lower = [axis[0] for axis in table.axes]
+    upper = [axis[-1] for axis in table.axes]
+    for point in np.random.uniform(lower, upper, (n,3)):
+        point = tuple(point)
+        J_table = SRPCost(table.lookup(*point), sim, None, *point)
+        t0 = time()
+        x, J_plan = table.plan(*point, sim=sim)
+        t_plan = time()-t0
+        t0 = time()
+        sol = surrogate(SRPCost, [(0,250),(100,400),(100,450)], EntrySimulation, args=(None,)+point, output=False)
+        t_full = time()-t0
+        print "V0 = {:.0f} m/s, fpa = {:.2f} deg, DR = {:.0f} km: lookup cost {:.2f}, polished {:.2f} in {:.1f} s, full optimization {:.2f} in {:.1f} s".format(
+               point[0], np.degrees(point[1]), point[2], J_table, J_plan, t_plan, sol.fun, t_full)
+    return table
     
     
 def ExpandBank():
@@ -334,15 +530,14 @@ def ExpandBank():
     # polynomials = cp.orth_chol(order=2,dist=pdf) 
     
     if 1:
-        nodes, weights = cp.generate_quadrature(order=2, domain=pdf, rule="Gaussian")
+        nodes, weights = cp.generate_quadrature(2, pdf, rule="G")
         # nodes, weights = cp.generate_quadrature(order=2, domain=pdf, rule="C")
         # nodes, weights = cp.generate_quadrature(order=9, domain=pdf, rule="L")
-        print nodes.shape
-        samples = np.array([hep(t,*node) for node in nodes.T])
+        samples = HEPBankBatch(t, nodes.T, profile=hep)
         hepPCE = cp.fit_quadrature(polynomials,nodes,weights,samples)
     else:
         nodes = pdf.sample(10,'S')
-        samples = np.array([hep(t,*node) for node in nodes.T])
+        samples = HEPBankBatch(t, nodes.T, profile=hep)
         hepPCE = cp.fit_regression(polynomials, nodes, samples,rule='T')
     return hepPCE
 
@@ -1,10 +1,15 @@
-from math import exp
+from numpy import exp
+
+
+SPEED_OF_SOUND = (223.8, -0.2004e-3, -1.588e-8, 1.404e-13)   # Coefficients of the cubic fit of the speed of sound in altitude on Mars
 
 
 class Planet:
     def __init__(self, name = 'Mars', rho0 = 0, scaleHeight = 0):
         
         self.name = name.capitalize()
+        self.__lat0 = None          # Initial latitude of the most recent range or coord computation, and its sine and cosine
+        self.__trig0 = None
         
         if self.name == 'Mercury':
             self.radius = float('nan')  # equatorial radius, m
@@ -52,44 +57,68 @@ class Planet:
             print 'Input planet name, '+ self.name +', is not valid'
         
     def atmosphere(self, h):
+        """ Returns the density and speed of sound at altitude h, which may be a scalar or an array. """
         #Density computation:
-            rho0 = self.rho0
-            scaleHeight = self.scaleHeight
-            rho = rho0*exp(-h/scaleHeight)
+        rho0 = self.rho0
+        scaleHeight = self.scaleHeight
+        rho = rho0*exp(-h/scaleHeight)
         # Local speed of sound computation:
-            coeff = [223.8, -0.2004e-3, -1.588e-8, 1.404e-13]
-            a = sum([c*h**i for i,c in enumerate(coeff)])
-            return rho,a
+        c0,c1,c2,c3 = SPEED_OF_SOUND
+        a = c0 + h*(c1 + h*(c2 + h*c3))
+        return rho,a
+        
+    def atmosphere_derivatives(self, h):
+        """ Returns the derivatives of the density and speed of sound with respect to altitude. """
+        rho = self.rho0*exp(-h/self.scaleHeight)
+        c0,c1,c2,c3 = SPEED_OF_SOUND
+        return -rho/self.scaleHeight, c1 + h*(2*c2 + 3*h*c3)
 
             
     def range(self,lon0,lat0,heading0,lonc,latc,km=False):
-        '''Computes the downrange and crossrange between two lat/lon pairs with a given initial heading.'''
-        from numpy import arccos, arcsin, sin, cos, pi, nan_to_num, zeros_like
+        '''Computes the downrange and crossrange between two lat/lon pairs with a given initial heading. lonc and latc may be arrays, e.g. an entire trajectory.'''
+        from numpy import arccos, arcsin, arctan2, sin, cos, pi, nan_to_num, ndim, clip
         
-        LF = arccos(sin(latc)*sin(lat0)+cos(latc)*cos(lat0)*cos(lonc-lon0))
-        if LF < 1e-5:
-            sig = zeros_like(lonc)
-        else:
-            sig = arcsin(sin(lonc-lon0)*cos(latc)/sin(LF))
+        sinlat0,coslat0 = self.__trig(lat0)
+        sinlatc,coslatc = sin(latc), cos(latc)
+        dlon = lonc-lon0
+        LF = arccos(clip(sinlatc*sinlat0+coslatc*coslat0*cos(dlon), -1, 1))
+        sig = arctan2(sin(dlon)*coslatc, coslat0*sinlatc - sinlat0*coslatc*cos(dlon))   # Bearing of each point from north, in all four quadrants
         zeta = sig+heading0-pi/2.
         
         DR = nan_to_num(self.radius*arccos(cos(LF)/cos(arcsin(sin(LF)*sin(zeta)))))
         CR = nan_to_num(self.radius*arcsin(sin(LF)*sin(zeta)))
+        if not ndim(DR):
+            DR,CR = float(DR),float(CR)
         if km:
             return DR/1000., CR/1000.
         else:
             return DR,CR
         
     def coord(self,lon0,lat0,heading0,dr,cr):
-        '''Computes the coords of a target a given downrange and crossrange from an initial location and heading.'''
-        from numpy import arccos, arcsin, sin, cos, pi
+        '''Computes the coords of a target a given downrange and crossrange from an initial location and heading. dr and cr may be arrays.'''
+        from numpy import arccos, arcsin, sin, cos, pi, where, ndim, clip
 
+        sinlat0,coslat0 = self.__trig(lat0)
         LF = arccos(cos(dr/self.radius)*cos(cr/self.radius))
-        zeta = arcsin(sin(CR/self.radius)/sin(LF))
-        lat = arcsin(cos(zeta-heading0+pi/2.)*cos(lat0)*sin(LF)+sin(lat0)*cos(LF))
+        near = LF < 1e-10
+        zeta = where(near, 0, arcsin(clip(sin(cr/self.radius)/where(near, 1, sin(LF)), -1, 1)))
+        lat = arcsin(cos(zeta-heading0+pi/2.)*coslat0*sin(LF)+sinlat0*cos(LF))
         lon = lon0 + arcsin(sin(zeta-heading0+pi/2)*sin(LF)/cos(lat))
+        if not ndim(lon):
+            lon,lat = float(lon),float(lat)
         return lon,lat
         
+    def __trig(self, lat0):
+        ''' Returns the sine and cosine of the initial latitude, cached since whole trajectories are measured from the same initial point. '''
+        from numpy import sin, cos, ndim
+        
+        if ndim(lat0):                                                      # One initial point per sample, as in a batch of trajectories
+            return sin(lat0), cos(lat0)
+        if lat0 != self.__lat0:
+            self.__lat0 = lat0
+            self.__trig0 = (sin(lat0), cos(lat0))
+        return self.__trig0
+        
 def getDifference(rho0, scaleHeight):
     import numpy as np
     
@@ -97,10 +126,10 @@ def getDifference(rho0, scaleHeight):
     dispersed = Planet(rho0=rho0,scaleHeight=scaleHeight)
     
     h = np.linspace(0,127e3,1000) # meters
-    rho_nom = [nominal.atmosphere(H)[0] for H in h]
-    rho_dis = [dispersed.atmosphere(H)[0] for H in h]
-    diff = np.array(rho_dis)-np.array(rho_nom)
-    perdiff = 100*diff/np.array(rho_nom)
+    rho_nom = nominal.atmosphere(h)[0]
+    rho_dis = dispersed.atmosphere(h)[0]
+    diff = rho_dis-rho_nom
+    perdiff = 100*diff/rho_nom
     return perdiff
     
 def compare():
@@ -121,5 +150,21 @@ def compare():
     plt.ylabel('Density variation (%)')
     plt.show()
     
+def testRange(n=1000):
+    ''' Checks that range inverts coord for downranges and crossranges of both signs, for scalars and arrays. '''
+    import numpy as np
+    
+    mars = Planet()
+    lon0, lat0, heading0 = np.radians(-90.07), np.radians(-43.90), np.radians(4.99)
+    for dr,cr in [(100e3,20e3), (100e3,-20e3), (500e3,50e3), (500e3,-50e3), (1000e3,0.)]:
+        DR,CR = mars.range(lon0, lat0, heading0, *mars.coord(lon0, lat0, heading0, dr, cr))
+        assert abs(DR-dr) < 1e-3 and abs(CR-cr) < 1e-3, (dr, cr, DR, CR)
+        
+    dr = np.random.uniform(1e3, 1500e3, n)
+    cr = np.random.uniform(-200e3, 200e3, n)
+    DR,CR = mars.range(lon0, lat0, heading0, *mars.coord(lon0, lat0, heading0, dr, cr))
+    print "Maximum round trip error: downrange {:.2e} m, crossrange {:.2e} m".format(np.abs(DR-dr).max(), np.abs(CR-cr).max())
+    
+    
 if __name__ == "__main__":
     compare()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os, sys, inspect
 import numpy as np
-from scipy.integrate import odeint, trapz
+from scipy.integrate import odeint, trapz, RK23, RK45, Radau, BDF, LSODA
+from scipy.optimize import brentq
 from scipy import linalg
 from scipy.interpolate import interp1d
 from scipy.io import savemat, loadmat
@@ -10,6 +11,7 @@ from transitions import Machine, State, logger
 from EntryEquations import Entry, System
 from Planet import Planet
 from EntryVehicle import EntryVehicle
+from Triggers import TriggerInput, select
 
 # Graphing specific imports
 from transitions.extensions import GraphMachine as MGraph
@@ -25,6 +27,74 @@ class Cycle(object): #Guidance Cycle
             self.duration = 1./freq
             self.rate = freq
                
+class History(object):
+    '''
+        A growable store of the times, states and controls logged during a simulation.
+        
+        Rows are kept in a single preallocated block that doubles in size when it fills. The times, states and controls members are views
+        into the used rows of the block, so reading them does not copy. reset empties the store but keeps the block, so repeated runs of 
+        the same Simulation do not reallocate. Views obtained before a reset or a growth are not updated and may be overwritten.
+        
+        Each row holds a logged time and state and the control applied from that time until the next row, which is only known when the 
+        next row is appended. The final row's control is set by close.
+    '''
+    
+    def __init__(self, capacity=512):
+        self.__capacity = capacity
+        self.__block = None
+        self.__nx = None
+        self.__n = 0
+        
+    def __len__(self):
+        return self.__n
+        
+    def reset(self):
+        self.__n = 0
+        
+    def append(self, time, x, u=None):
+        """ Logs the state x at a given time. u is the control that was applied since the previous row. """
+        nx = len(x)
+        if self.__block is None or nx != self.__nx:
+            self.__nx = nx
+            self.__block = np.empty((self.__capacity, 4+nx))
+            self.__n = 0
+        elif self.__n == self.__block.shape[0]:
+            block = np.empty((2*self.__n, self.__block.shape[1]))
+            block[:self.__n] = self.__block
+            self.__block = block
+            
+        if u is not None and self.__n:
+            self.__block[self.__n-1, 1+nx:] = u
+        row = self.__block[self.__n]
+        row[0] = time
+        row[1:1+nx] = x
+        row[1+nx:] = np.nan
+        self.__n += 1
+    
+    def close(self, u):
+        """ Sets the control of the final row, so that the control history has the same length as the state history. """
+        if self.__n and u is not None:
+            self.__block[self.__n-1, 1+self.__nx:] = u
+            
+    @property
+    def times(self):
+        return self.__block[:self.__n, 0]
+        
+    @property
+    def states(self):
+        return self.__block[:self.__n, 1:1+self.__nx]
+        
+    @property
+    def controls(self):
+        return self.__block[:self.__n, 1+self.__nx:]
+        
+        
+class Aborted(Exception):
+    ''' Raised within a run when its abort predicate ends it early. '''
+    
+    
+# Adaptive solvers available to Simulation in addition to the legacy fixed-slice odeint integration
+integrators = {'RK23' : RK23, 'RK45' : RK45, 'Radau' : Radau, 'BDF' : BDF, 'LSODA' : LSODA}
     
 class Simulation(Machine):   
     '''
@@ -35,14 +105,32 @@ class Simulation(Machine):
             getRef - Returns a dictionary of interpolation objects
             plot   - Plots a set of standard graphs. Does not show them, use Simulation.show() to bring them up. This can be useful to plot multiple trajectories before calling show.
             
+        Integration:
+            By default each phase is propagated by a single adaptive solver (any key of integrators) that is only restarted when the control changes
+            between guidance cycles. Triggers with event functions are root-found to their exact crossing time rather than checked at cycle boundaries.
+            integrator='odeint' restores the original behavior of one odeint call per guidance cycle.
+            
+        Terminal runs:
+            run(..., TerminalOnly=True) logs only the initial and final states and returns the single post-processed row of the final state,
+            for optimizers that only use the end of the trajectory. The history is then unavailable to plot and getRef, and only the final row
+            of the control history is set. Triggers and controllers are still evaluated every cycle, and with the integration they dominate the
+            run time, so only the logging and post-processing are saved.
+            
+        Aborting:
+            run(..., Abort=abort) calls abort with the trigger and controller inputs it requires after every guidance cycle. A return value other
+            than None or False ends the run early, e.g. a cost penalty for a trajectory that can no longer reach its target, and is stored in
+            aborted. The output is that of the trajectory flown so far.
+            
         Members:
         
     '''
     
-    def __init__(self, states, conditions, cycle=None, output=True):
+    def __init__(self, states, conditions, cycle=None, output=True, integrator='RK45', rtol=1e-8, atol=1e-8):
 
         if len(states) != len(conditions):
             raise ValueError("Number of states must equal number of conditions.")
+        if integrator != 'odeint' and integrator not in integrators:
+            raise ValueError("Unknown integrator {}, options are 'odeint' or one of {}.".format(integrator, sorted(integrators.keys())))
             
         if cycle is None:
             if output:
@@ -52,20 +140,27 @@ class Simulation(Machine):
         self.__conditions = conditions
         self.__states = states
         self.__output = output
-        
-        self.cycle = cycle          # The guidance cycle governing the simulation. Data logging and control updates occur every cycle.duration seconds while trigger checking happens 10x per cycle
+        self.__integrator = integrator
+        self.__tol = (rtol, atol)
+        self.__solver = None        # The adaptive solver propagating the current phase, None when it must be restarted
+        self.__solverControl = None # The control held constant by the current solver
+        self.__event = False        # Whether the current phase's trigger event has been located
+        self.__terminal = False     # Whether only the initial and final states are logged
+        self.__abort = None         # The predicate checked every cycle to end a run early
+        
+        self.cycle = cycle          # The guidance cycle governing the simulation. Data logging and control updates occur every cycle.duration seconds, triggers with event functions are located exactly
         self.time = 0.0             # Current simulation time
-        self.times = []             # Collection of times at which the state history is logged
+        self.log = History()        # Times, states and controls logged every cycle. Also available as the times, history and control_history views
         self.index = 0              # The index of the current phase
         self.sample = None          # Uncertainty sample to be run
         self.x = None               # Current state vector
-        self.history = []           # Collection of state vectors
         self.u = None               # Previous controls
-        self.control_history = []   # Collection of controls
         self.ie = [0]               # Indices of event transitions
         self.edlModel = None        # The dynamics and other functions associated with EDL
         self.fullEDL = None         # The type of edl model used - "ideal" with perfect knowledge and no bank angle constraints, or "full" truth/nav/constraints/filters etc
         self.triggerInput = None    # An input to triggers and controllers
+        self.stats = {}             # The stats of each phase's controller that records any, e.g. MPC.NMPC, keyed by phase name
+        self.aborted = None         # The value returned by the abort predicate if it ended the most recent run, otherwise None
         
         states.append('Complete')
         transitions = [{'trigger':'advance', 'source':states[i-1], 'dest':states[i], 'conditions':'integrate'} for i in range(1,len(states))]
@@ -83,33 +178,92 @@ class Simulation(Machine):
     
     def integrate(self):
     
-        while not self.__conditions[self.index](self.triggerInput):
-            if self.__output and not len(self.history)%10:
+        while not (self.__event or self.__conditions[self.index](self.triggerInput)):
+            if self.__output and not len(self.log)%10:
                 print "current simulation time = {} s".format(self.time) # Should define a pretty print function and call that here
             temp = self.__step() #Advance the numerical simulation, save resulting states for next check etc
-
+            if self.__abort is not None and not self.__event:
+                penalty = self.__abort(**select(self.__abort, self.triggerInput))
+                if penalty is not None and penalty is not False:
+                    self.aborted = penalty
+                    raise Aborted()
+
+        self.__event = False
+        self.__solver = None        # Each phase begins with a fresh solver since the dynamics or controller may change
         return True
     
     
     def __step(self):
+        controller = self.control[self.index]
         if self.edlModel.powered:
-            throttle, mu = self.control[self.index](**self.triggerInput)
+            throttle, mu = controller(**select(controller, self.triggerInput))
             sigma = 0.
         else:
-            sigma = self.control[self.index](**self.triggerInput)
+            sigma = controller(**select(controller, self.triggerInput))
             throttle = 0.
             mu = 0.
+        u = np.asarray([sigma,throttle,mu])
             
+        if self.__integrator == 'odeint':
+            X = odeint(self.edlModel.dynamics((sigma,throttle,mu)), self.x, np.linspace(self.time,self.time+self.cycle.duration,10))
+            self.update(X,self.cycle.duration,u)
+        else:
+            self.__adaptiveStep(u)
+            
+    def __adaptiveStep(self, u):
+        """ Advances the adaptive solver to the end of the guidance cycle, or to the exact time of the current trigger's event if it occurs first. """
+        
+        if self.__solver is None or not np.array_equal(u, self.__solverControl):
+            f = self.edlModel.dynamics(u)
+            rtol,atol = self.__tol
+            self.__solver = integrators[self.__integrator](lambda t,x: f(x,t), self.time, self.x, np.inf, rtol=rtol, atol=atol)
+            self.__solverControl = u
+        solver = self.__solver
+        
+        condition = self.__conditions[self.index]
+        if getattr(condition, 'hasEvent', False):
+            g = lambda t,x: condition.event(self.getDict(x,t))
+            g_start = condition.event(self.triggerInput)
+        else:
+            g = None
+            
+        t_start = self.time
+        t_cycle = self.time + self.cycle.duration
+        while True:
+            if solver.t <= t_start:
+                message = solver.step()
+                if solver.status == 'failed':
+                    raise RuntimeError('Integration failed at t = {} s: {}'.format(solver.t, message))
+            sol = solver.dense_output()
+            t_end = min(solver.t, t_cycle)
+            
+            if g is not None:
+                g_end = g(t_end, sol(t_end))
+                if g_end >= 0:
+                    if g_start < 0:
+                        t_event = brentq(lambda t: g(t, sol(t)), t_start, t_end, xtol=1e-10)
+                    else:
+                        t_event = t_start
+                    self.update(sol(t_event), t_event-self.time, u)
+                    self.__event = True
+                    return
+                g_start = g_end
+                
+            if solver.t >= t_cycle:
+                self.update(sol(t_cycle), t_cycle-self.time, u)
+                return
+            t_start = t_end
             
-        X = odeint(self.edlModel.dynamics((sigma,throttle,mu)), self.x, np.linspace(self.time,self.time+self.cycle.duration,10))
-        #find nearest endpoint here
-        self.update(X,self.cycle.duration,np.asarray([sigma,throttle,mu]))
-
         
-    def run(self, InitialState, Controllers, InputSample=None, FullEDL=False, AeroRatios=(1,1)):
-        """ Runs the simulation from a given a initial state, with the specified controllers in each phase, and using a chosen sample of the uncertainty space """
+    def run(self, InitialState, Controllers, InputSample=None, FullEDL=False, AeroRatios=(1,1), TerminalOnly=False, Abort=None):
+        """ Runs the simulation from a given a initial state, with the specified controllers in each phase, and using a chosen sample of the uncertainty space.
+            With TerminalOnly only the initial and final states are logged, and the output is the (1, n) post-processed row of the final state.
+            Abort, if given, is checked every guidance cycle and may end the run early, see the class documentation.
+        """
         
         self.reset()
+        self.__terminal = TerminalOnly
+        self.__abort = Abort
         
         if InputSample is None:
             InputSample = np.zeros(4)
@@ -124,12 +278,16 @@ class Simulation(Machine):
             self.edlModel.update_ratios(LR=AeroRatios[0],DR=AeroRatios[1])
         self.update(np.asarray(InitialState),0.0,None)
         self.control = Controllers
-        while not self.is_Complete():
-            temp = self.advance()
+        try:
+            while not self.is_Complete():
+                temp = self.advance()
+        except Aborted:
+            pass
     
-        self.history = np.vstack(self.history)                  # So that we can work with the data more easily than a list of arrays
-        self.control_history.append(self.u)                     # So that the control history has the same length as the data;
-        self.control_history = np.vstack(self.control_history) 
+        if self.__terminal:
+            self.log.append(self.time, self.x)                  # The initial row is kept as the origin of downrange and crossrange, its control untouched
+        self.log.close(self.u)                                  # So that the control history has the same length as the data
+        self.stats = dict((self.__states[i], controller.stats) for i,controller in enumerate(Controllers) if hasattr(controller, 'stats'))
         
         return self.postProcess()
 
@@ -142,14 +300,25 @@ class Simulation(Machine):
         
         if u is not None:
             self.u = u    
-            self.control_history.append(self.u)
             
-        self.history.append(self.x)
         self.time += dt
-        self.times.append(self.time)
-        self.triggerInput = self.getDict()
+        if not (self.__terminal and len(self.log)):
+            self.log.append(self.time, self.x, u)
+        self.triggerInput = self.getDict(self.x, self.time)
 
         
+    @property
+    def times(self):
+        return self.log.times
+        
+    @property
+    def history(self):
+        return self.log.states
+        
+    @property
+    def control_history(self):
+        return self.log.controls
+        
     def printState(self):        
         
         if self.__output:
@@ -158,48 +327,51 @@ class Simulation(Machine):
             for key,value in self.triggerInput.items():
                 print '{} : {}\n'.format(key,value)
         self.index += 1
-        self.ie.append(len(self.history)-1)
+        self.ie.append(len(self.log)-1)
     
     
-    def getDict(self):
+    def getDict(self, x=None, time=None):
+        """ Returns the inputs to triggers and controllers at the current state, or at a given state and time.
+            The altitude and aerodynamic forces are only computed if a trigger or controller reads them.
+        """
+        if x is None:
+            x = self.x
+        if time is None:
+            time = self.time
+            
         if self.fullEDL:
-            L,D = self.edlModel.nav.aeroforces(np.array([self.x[0]]),np.array([self.x[3]]))
-
+            model = self.edlModel.nav
             d =  {
-                  'time'            : self.time,
-                  'altitude'        : self.edlModel.nav.altitude(self.x[0]),
-                  'longitude'       : self.x[1],
-                  'latitude'        : self.x[2],
-                  'velocity'        : self.x[3],
-                  'fpa'             : self.x[4],
-                  'mass'            : self.x[7],
-                  'rangeToGo'       : self.x[6],
-                  'drag'            : D[0],
-                  'lift'            : L[0],
-                  'vehicle'         : self.edlModel.nav.vehicle,
-                  'current_state'   : self.x[8:16], # Should probably just return the current NAV state, since that's what we will propagate within a controller
-                  'aero_ratios'     : self.x[16:18]
+                  'time'            : time,
+                  'longitude'       : x[1],
+                  'latitude'        : x[2],
+                  'velocity'        : x[3],
+                  'fpa'             : x[4],
+                  'mass'            : x[7],
+                  'rangeToGo'       : x[6],
+                  'vehicle'         : model.vehicle,
+                  'current_state'   : x[8:16], # Should probably just return the current NAV state, since that's what we will propagate within a controller
+                  'aero_ratios'     : x[16:18]
                   }        
         else:
-            L,D = self.edlModel.aeroforces(np.array([self.x[0]]),np.array([self.x[3]]))
-
+            model = self.edlModel
             d =  {
-                  'time'            : self.time,
-                  'altitude'        : self.edlModel.altitude(self.x[0]),
-                  'longitude'       : self.x[1],
-                  'latitude'        : self.x[2],
-                  'velocity'        : self.x[3],
-                  'fpa'             : self.x[4],
-                  'mass'            : self.x[7],
-                  'rangeToGo'       : self.x[6],
-                  'drag'            : D[0],
-                  'lift'            : L[0],
-                  'vehicle'         : self.edlModel.vehicle,
-                  'current_state'   : self.x,
-                  'aero_ratios'     : (self.edlModel.lift_ratio, self.edlModel.drag_ratio),
+                  'time'            : time,
+                  'longitude'       : x[1],
+                  'latitude'        : x[2],
+                  'velocity'        : x[3],
+                  'fpa'             : x[4],
+                  'mass'            : x[7],
+                  'rangeToGo'       : x[6],
+                  'vehicle'         : model.vehicle,
+                  'current_state'   : x,
+                  'aero_ratios'     : (model.lift_ratio, model.drag_ratio),
                   }
+                  
+        lazy = [(('altitude',), lambda: (model.altitude(x[0]),)),
+                (('lift','drag'), lambda: model.aeroforces(x[0],x[3]))]
         
-        return d
+        return TriggerInput(d, lazy)
     
     def ignite(self):
         self.edlModel.ignite()
@@ -250,22 +422,22 @@ class Simulation(Machine):
             bank, bank_rate = np.degrees(self.history[:,18]), np.degrees(self.history[:,19])
             
             x0 = self.history[0,:]
-            range = [self.edlModel.truth.planet.range(*x0[[1,2,5]],lonc=np.radians(lon),latc=np.radians(lat),km=True) for lon,lat in zip(theta,phi)]
-            range_nav = [self.edlModel.nav.planet.range(*x0[[9,10,13]],lonc=np.radians(lon),latc=np.radians(lat),km=True) for lon,lat in zip(theta_nav,phi_nav)]
+            DR,CR = self.edlModel.truth.planet.range(*x0[[1,2,5]],lonc=self.history[:,1],latc=self.history[:,2],km=True)
+            DR_nav,CR_nav = self.edlModel.nav.planet.range(*x0[[9,10,13]],lonc=self.history[:,9],latc=self.history[:,10],km=True)
             
             energy = self.edlModel.truth.energy(r,v)
             energy_nav = self.edlModel.nav.energy(r_nav,v_nav)
 
                 
-            h = [self.edlModel.truth.altitude(R,km=True) for R in r]
-            h_nav = [self.edlModel.nav.altitude(R,km=True) for R in r_nav]
+            h = self.edlModel.truth.altitude(r,km=True)
+            h_nav = self.edlModel.nav.altitude(r_nav,km=True)
             L,D = self.edlModel.truth.aeroforces(r,v)
             L_nav,D_nav = self.edlModel.nav.aeroforces(r_nav,v_nav)
         
         
         
-            data = np.c_[self.times, energy, bank_cmd, h,   r,      theta,       phi,      v,         gamma,     psi,       range,     L,      D,
-                                     energy_nav, bank, h_nav, r_nav, theta_nav,  phi_nav,  v_nav,     gamma_nav, psi_nav,   range_nav, L_nav,  D_nav]
+            data = np.c_[self.times, energy, bank_cmd, h,   r,      theta,       phi,      v,         gamma,     psi,       DR,     CR,     L,      D,
+                                     energy_nav, bank, h_nav, r_nav, theta_nav,  phi_nav,  v_nav,     gamma_nav, psi_nav,   DR_nav, CR_nav, L_nav,  D_nav]
         else:
             bank_cmd = np.degrees(self.control_history[:,0])
 
@@ -274,14 +446,16 @@ class Simulation(Machine):
             s,m         = (self.history[0,6]-self.history[:,6])/1000, self.history[:,7]
             
             x0 = self.history[0,:]
-            range = [self.edlModel.planet.range(*x0[[1,2,5]],lonc=np.radians(lon),latc=np.radians(lat),km=True) for lon,lat in zip(theta,phi)]
+            DR,CR = self.edlModel.planet.range(*x0[[1,2,5]],lonc=self.history[:,1],latc=self.history[:,2],km=True)
             energy = self.edlModel.energy(r,v)
                 
-            h = [self.edlModel.altitude(R,km=True) for R in r]
+            h = self.edlModel.altitude(r,km=True)
             L,D = self.edlModel.aeroforces(r,v)
             
-            data = np.c_[self.times, energy, bank_cmd, h,   r,      theta,       phi,      v,         gamma, psi,       range,     L,      D]
+            data = np.c_[self.times, energy, bank_cmd, h,   r,      theta,       phi,      v,         gamma, psi,       DR,     CR,     L,      D]
             
+        if self.__terminal:
+            data = data[-1:]
         self.output = data
         return data
         
@@ -290,18 +464,23 @@ class Simulation(Machine):
             print "Resetting simulation states.\n"
         self.set_state(self.__states[0])
         self.time = 0.0
-        self.times = []
+        self.log.reset()            # Keeps the preallocated history block for reuse
         self.index = 0
         self.sample = None          # Input uncertainty sample
         self.x = None               # Current State vector
-        self.history = []           # Collection of State Vectors
         self.u = None
-        self.control_history = []   # Collection of State Vectors
         self.ie = [0]
         self.edlModel = None
         self.triggerInput = None
         self.control = None
         self.output = None
+        self.stats = {}
+        self.__solver = None
+        self.__solverControl = None
+        self.__event = False
+        self.__terminal = False
+        self.__abort = None
+        self.aborted = None
         
         
     def getRef(self):
@@ -384,12 +563,12 @@ def simPlot(edlModel, time, history, control_history, plotEvents, fsm_states, ie
     # plt.ylabel(label+'Bank Angle (deg)')
     
     # Downrange vs Crossrange
-    range = np.array([edlModel.planet.range(*history[0,[1,2,5]],lonc=lon,latc=lat,km=True) for lon,lat in zip(history[:,1],history[:,2])])
+    DR,CR = edlModel.planet.range(*history[0,[1,2,5]],lonc=history[:,1],latc=history[:,2],km=True)
     plt.figure(fignum)
     fignum += 1        
-    plt.plot(range[:,1], range[:,0])
+    plt.plot(CR, DR)
     for i in ie:
-        plt.plot(range[i,1], range[i,0],'o',label = fsm_states[ie.index(i)])
+        plt.plot(CR[i], DR[i],'o',label = fsm_states[ie.index(i)])
     plt.legend(loc='best')   
     plt.xlabel(label+'Cross Range (km)')
     plt.ylabel(label+'Down Range (km)')
@@ -431,6 +610,24 @@ def EntrySim():
     trigger = [VelocityTrigger(500)]
     return {'states':states, 'conditions':trigger}
     
+def NominalEntry():
+    ''' Returns the initial state of the nominal entry, 1000 km from its target, and the open loop HEP bank profile flown to it. '''
+    from ParametrizedPlanner import HEPBank
+    
+    bankProfile = lambda **d: HEPBank(d['time'],*[ 165.4159422 ,  308.86420218,  399.53393904])
+    bankProfile.requires = ('time',)
+    r0, theta0, phi0, v0, gamma0, psi0,s0 = (3540.0e3, np.radians(-90.07), np.radians(-43.90),
+                                             5505.0,   np.radians(-14.15), np.radians(4.99),   1000e3)
+    x0 = np.array([r0, theta0, phi0, v0, gamma0, psi0, s0, 8500.0])
+    return x0, bankProfile
+    
+def NominalReference():
+    ''' Flies the nominal entry open loop, returning its initial state, bank profile and the simulation from which getRef gives the references. '''
+    x0, bankProfile = NominalEntry()
+    reference_sim = Simulation(cycle=Cycle(1),output=False,**EntrySim())
+    reference_sim.run(x0,[bankProfile])
+    return x0, bankProfile, reference_sim
+    
 def testSim():
 
     sim = Simulation(cycle=Cycle(1),**SRP())
@@ -455,6 +652,23 @@ def testFullSim():
     sim.run(x0,c, FullEDL=True)
     return sim
 
+def testTerminalOnly(n=20):
+    ''' Checks that a terminal only run reproduces the final row of a full run, and compares their run times. '''
+    from time import time
+    
+    sim = Simulation(cycle=Cycle(1),output=False,**EntrySim())
+    x0, bankProfile = NominalEntry()
+    
+    timing, outputs = [], []
+    for terminal in (False, True):
+        t0 = time()
+        for _ in range(n):
+            output = sim.run(x0,[bankProfile],TerminalOnly=terminal)
+        timing.append((time()-t0)/n)
+        outputs.append(output[-1])
+    print "Full run {:.1f} ms, terminal only {:.1f} ms".format(timing[0]*1e3, timing[1]*1e3)
+    print "Maximum difference in the final row: {}".format(np.abs(outputs[0]-outputs[1]).max())
+
 def NMPCSim(options):
     from Triggers import TimeTrigger
     states = ['State{}'.format(i) for i in range(0,options['N'])]
@@ -600,7 +814,9 @@ if __name__ == '__main__':
     # pre = partial(constant, value=bankProfile(time=0))
     # controls = [pre,mpc]
     
-    # # Run the off-nominal simulations
-    # stateTensor = [sim.run(x0,controls,s) for s in samples.T]
+    # # Run the off-nominal simulations over a process pool, each worker building its own simulation
+    # from MonteCarlo import Campaign
+    # mc = Campaign(lambda: Simulation(cycle=Cycle(1),output=False,states=['PreEntry','Entry'],conditions=conditions), controls, x0)
+    # stateTensor = mc.run(samples)
     # saveDir = './data/'
     # savemat(saveDir+'MC',{'states':stateTensor, 'samples':samples, 'pdf':p})
\ No newline at end of file
@@ -1,16 +1,78 @@
 from functools import partial
+from collections import Mapping
 
 
+class TriggerInput(Mapping):
+    '''
+        The read-only mapping of quantities passed to triggers and controllers.
+        
+        values - a dict of quantities known up front
+        lazy   - a list of (keys, fun) pairs. fun takes no arguments and returns a tuple of the values of keys. It is called the first time
+                 any of keys is read, and its results are cached, so quantities such as the aerodynamic forces are only computed when needed.
+        
+        Unpacking the mapping with ** reads every key; use select to pass only the quantities a trigger or controller declares it requires.
+    '''
+    
+    def __init__(self, values, lazy=()):
+        self.__values = values
+        self.__pending = {}
+        for keys,fun in lazy:
+            for key in keys:
+                self.__pending[key] = (keys,fun)
+                
+    def __getitem__(self, key):
+        if key in self.__pending:
+            keys,fun = self.__pending[key]
+            for k,value in zip(keys, fun()):
+                self.__values[k] = value
+                del self.__pending[k]
+        return self.__values[key]
+            
+    def __iter__(self):
+        return iter(self.keys())
+        
+    def keys(self):
+        return list(self.__values) + list(self.__pending)
+            
+    def __len__(self):
+        return len(self.__values) + len(self.__pending)
+        
+    def __contains__(self, key):
+        return key in self.__values or key in self.__pending
+        
+        
+def select(fun, input):
+    ''' Returns the keyword arguments with which to call a trigger function or controller: only the quantities listed in its requires attribute, if it has one. '''
+    requires = getattr(fun, 'requires', None)
+    if requires is None:
+        return input
+    return {key : input[key] for key in requires}
+    
+    
 class Trigger(object):
     '''
         Although purely functional triggers work, it's nice for them to encapsulate knowledge about themselves such as their type and trigger point
+        
+        A trigger may also supply an event function, a continuous function of the same inputs that is negative before the trigger point and 
+        non-negative once it is satisfied. Simulations use it to locate the exact time at which the trigger fires.
+        
+        requires lists the input quantities the trigger reads, so that only those are computed from a TriggerInput. None passes every quantity.
     '''
-    def __init__(self, fun, info):
+    def __init__(self, fun, info, event=None, requires=None):
         self.__trigger = fun
         self.__info = info
+        self.__event = event
+        self.requires = requires
 
     def __call__(self, input):
-        return self.__trigger(**input)
+        return self.__trigger(**select(self, input))
+
+    @property
+    def hasEvent(self):
+        return self.__event is not None
+        
+    def event(self, input):
+        return self.__event(**select(self, input))
 
 
     def dump(self):
@@ -24,18 +86,24 @@ class VelocityTrigger(Trigger):
     def __Trigger(self, velocity, **kwargs):
         return velocity <= self.__vt
     
+    def __Event(self, velocity, **kwargs):
+        return self.__vt - velocity
+    
     def __init__(self,velTrigger):
         self.__vt = velTrigger
-        super(VelocityTrigger,self).__init__(self.__Trigger, 'Velocity <= {} m/s'.format(velTrigger))
+        super(VelocityTrigger,self).__init__(self.__Trigger, 'Velocity <= {} m/s'.format(velTrigger), self.__Event, ('velocity',))
 
 class AltitudeTrigger(Trigger):
 
     def __Trigger(self, altitude, **kwargs):       
         return altitude <= self.__at
 
+    def __Event(self, altitude, **kwargs):
+        return self.__at - altitude
+        
     def __init__(self,altTrigger):
         self.__at = altTrigger*1000 # Assumed that the trigger is defined in km while the input from the sim will definitely be in meters
-        super(AltitudeTrigger,self).__init__(self.__Trigger, 'Altitude <= {} km'.format(altTrigger))    
+        super(AltitudeTrigger,self).__init__(self.__Trigger, 'Altitude <= {} km'.format(altTrigger), self.__Event, ('altitude',))    
         
 class AccelerationTrigger(Trigger):
     # Can be used with drag, lift, acc magnitude etc, useful for pre-entry
@@ -43,10 +111,13 @@ class AccelerationTrigger(Trigger):
     def __Trigger(self, **kwargs):
         return kwargs[self.__name] >= self.__at
     
+    def __Event(self, **kwargs):
+        return kwargs[self.__name] - self.__at
+        
     def __init__(self, accName, accTrigger):
         self.__at =  accTrigger
         self.__name = accName
-        super(AccelerationTrigger,self).__init__(self.__Trigger, '{} >= {} m/s^2'.format(accName.capitalize(),accTrigger))   
+        super(AccelerationTrigger,self).__init__(self.__Trigger, '{} >= {} m/s^2'.format(accName.capitalize(),accTrigger), self.__Event, (accName,))   
     
 # class AngularTrigger(Trigger):
 
@@ -54,25 +125,34 @@ class MassTrigger(Trigger):
     def __Trigger(self, mass, **kwargs):
         return mass <= self.__mt
         
+    def __Event(self, mass, **kwargs):
+        return self.__mt - mass
+        
     def __init__(self, massTrigger):
         self.__mt = massTrigger
-        super(MassTrigger,self).__init__(self.__Trigger, 'Mass <= {} kg'.format(massTrigger))
+        super(MassTrigger,self).__init__(self.__Trigger, 'Mass <= {} kg'.format(massTrigger), self.__Event, ('mass',))
 
 class TimeTrigger(Trigger):
     def __Trigger(self, time, **kwargs):
         return time >= self.__tt
         
+    def __Event(self, time, **kwargs):
+        return time - self.__tt
+        
     def __init__(self, timeTrigger):
         self.__tt = timeTrigger
-        super(TimeTrigger,self).__init__(self.__Trigger, 'Time elapsed >= {} s'.format(timeTrigger))        
+        super(TimeTrigger,self).__init__(self.__Trigger, 'Time elapsed >= {} s'.format(timeTrigger), self.__Event, ('time',))        
         
 class RangeToGoTrigger(Trigger):
     def __Trigger(self,rangeToGo, **kwargs):
         return rangeToGo <= self.__rtg
         
+    def __Event(self, rangeToGo, **kwargs):
+        return self.__rtg - rangeToGo
+        
     def __init__(self, rtgTrigger):
         self.__rtg = rtgTrigger
-        super(RangeToGoTrigger,self).__init__(self.__Trigger,'Range to go <= {} m'.format(rtgTrigger))
+        super(RangeToGoTrigger,self).__init__(self.__Trigger,'Range to go <= {} m'.format(rtgTrigger), self.__Event, ('rangeToGo',))
         
 # class LogicalTrigger(Trigger):
     # '''
@@ -84,82 +164,78 @@ class RangeToGoTrigger(Trigger):
         # self.__bools = Bools
         
         
+# The parachute deployment box in velocity (m/s) and altitude (km). Below the Mach limit the box is bounded by the minimum altitude, the
+# dynamic pressure limit raises the floor linearly between v and h, and the ceiling falls linearly between v2 and h2 at the highest velocities.
+_BOX_V = (438.5, 487.)
+_BOX_H = (6., 7.98)
+_BOX_V2 = (476.4, 487.)
+_BOX_H2 = (16.73, 7.98)
+_BOX_VMIN = 310.
+_BOX_FLOOR = (_BOX_H[1]-_BOX_H[0])/(_BOX_V[1]-_BOX_V[0])
+_BOX_CEILING = (_BOX_H2[1]-_BOX_H2[0])/(_BOX_V2[1]-_BOX_V2[0])
+
 def Parachute(alt,vel):
     '''
         Checks if the parachute should be deployed based on whether or not the current altitude (in km) and velocity (in m/s)
         satisfy the parachute's constraints on Mach number and dynamic pressure.
+        alt and vel may be scalars or broadcastable arrays, e.g. the terminal states of a Monte Carlo campaign.
         Outputs:
             Satisfied - bool, true if inside the safe deployment box
             Deploy - bool, true if too low or too slow
     '''
+    import numpy as np
+    
+    alt = np.asarray(alt, dtype=float)
+    vel = np.asarray(vel, dtype=float)
     
-    from scipy.interpolate import interp1d
-    v = [438.5,487]
-    h = [6,7.98]
-    
-    val = (alt >= h[0]) and (vel >= 310)
-    if val and (vel <= v[0]):
-        return True,False
-        
-    elif (vel > v[0]) and (vel < v[1]):
-        if (alt >= interp1d(v,h)(vel)):
-            v2 = [476.4,v[1]]
-            h2 = [16.73,h[1]]
-            if vel > v2[0]:
-                return (alt<=interp1d(v2,h2)(vel)),False
-            else:
-                return True,False
-        else:
-            return False,True
-    elif val:
-        return False,False
-    else:
-        return False,True
+    val = (alt >= _BOX_H[0]) & (vel >= _BOX_VMIN)
+    low = val & (vel <= _BOX_V[0])                                          # Below the Mach limit
+    ramp = ~low & (vel > _BOX_V[0]) & (vel < _BOX_V[1])                     # Within the dynamic pressure limit's velocities
+    above = alt >= _BOX_FLOOR*(vel-_BOX_V[0]) + _BOX_H[0]
+    below = (vel <= _BOX_V2[0]) | (alt <= _BOX_CEILING*(vel-_BOX_V2[0]) + _BOX_H2[0])
+    
+    Satisfied = low | (ramp & above & below)
+    Deploy = np.where(ramp, ~above, ~(low | val))
+    if Satisfied.ndim == 0:
+        return bool(Satisfied), bool(Deploy)
+    return Satisfied, Deploy
         
         
 def DeployParachute(rangeToGo,alt,vel,velBias = 0):
-    Satisfied,forceDeploy = Parachute(alt,vel+velBias)
-    return forceDeploy or (rangeToGo <= 0 and Satisfied)
+    ''' Whether to deploy the parachute, for scalars or broadcastable arrays of the range to go, altitude (km) and velocity (m/s). '''
+    import numpy as np
+    
+    Satisfied,forceDeploy = Parachute(alt,np.add(vel,velBias))
+    deploy = forceDeploy | ((np.asarray(rangeToGo) <= 0) & Satisfied)
+    if np.ndim(deploy) == 0:
+        return bool(deploy)
+    return deploy
     
     
 def ParachuteTest():
     import numpy as np
     import matplotlib.pyplot as plt
-    h = np.linspace(5,17)
-    v = np.linspace(300,500)
-    
-    for alt in h:
-        for vel in v:
-            inside,mustDeploy=Parachute(alt,vel)
-            if inside:
-                plt.plot(vel,alt,marker = 'o',color='b')
-            elif mustDeploy:
-                plt.plot(vel,alt,marker = 'x',color='r')
-                
-            else:
-                plt.plot(vel,alt,marker = 'x',color ='b')
-            
+    alt,vel = np.meshgrid(np.linspace(5,17), np.linspace(300,500))
+    
+    inside,mustDeploy = Parachute(alt,vel)
+    outside = ~(inside | mustDeploy)
+    plt.plot(vel[inside],alt[inside],'o',color='b')
+    plt.plot(vel[mustDeploy],alt[mustDeploy],'x',color='r')
+    plt.plot(vel[outside],alt[outside],'x',color='b')
     plt.show()
  
 def DeployParachuteTest():
     import numpy as np
     import matplotlib.pyplot as plt
-    h = np.linspace(5,17)
-    v = np.linspace(300,500)
+    alt,vel = np.meshgrid(np.linspace(5,17), np.linspace(300,500))
     s = [1,-1]
     title = ['Undershoot','Overshoot']
     for sign in s:
         plt.figure(s.index(sign))
         plt.title(title[s.index(sign)])
-        for alt in h:
-            for vel in v:
-                Deploy=DeployParachute(sign,alt,vel)
-                
-                if Deploy:
-                    plt.plot(vel,alt,marker = 'o',color='b')
-                else:
-                    plt.plot(vel,alt,marker = 'x',color='r')
-                
+        Deploy = DeployParachute(sign,alt,vel)
+        plt.plot(vel[Deploy],alt[Deploy],'o',color='b')
+        plt.plot(vel[~Deploy],alt[~Deploy],'x',color='r')
             
     plt.show()
         
@@ -2,6 +2,7 @@
 
 import numpy as np
 import chaospy as cp
+from collections import OrderedDict
 
 
 
@@ -29,4 +30,67 @@ def getUncertainty(parametric=True, initial=False, knowledge=False):
         gamma = cp.Normal(0, 2.0/3.0)    # Entry FPA deviation, +- 2 deg 3-sigma
         perturbations['initial'] = cp.J(V, gamma)
     
-    return perturbations
\ No newline at end of file
+    return perturbations
+
+class UQContext(object):
+    '''
+        The polynomial chaos basis and quadrature rule of a distribution, built once and shared by every robust cost evaluation.
+
+        The quadrature fit is linear in the values fitted, so the expectation of the expansion is a fixed weighting of the values at the nodes,
+        found once by fitting the identity. fit_and_expect then costs only a dot product. A context pickles without its distribution, which
+        chaospy cannot pickle, so copies sent to worker processes support everything but expect.
+
+        Members:
+            pdf         - the distribution, None in unpickled copies
+            polynomials - the orthogonal polynomials of the given order
+            nodes       - (dim, n) quadrature nodes at which the values are computed
+            weights     - (n,) quadrature weights
+            expectation - (n,) weights of the values in the expectation of their expansion
+
+        Methods:
+            fit            - returns the expansion fitted to the values at the nodes
+            expect         - returns the expectation of an expansion
+            fit_and_expect - returns the expectation of the expansion fitted to the values at the nodes
+    '''
+
+    def __init__(self, pdf, order=2, rule="G"):
+        self.pdf = pdf
+        self.order = order
+        self.rule = rule
+        self.polynomials = cp.orth_ttr(order=order, dist=pdf)
+        self.nodes, self.weights = cp.generate_quadrature(order, pdf, rule=rule)
+        self.expectation = np.asarray(self.expect(self.fit(np.eye(self.weights.size))), dtype=float)
+
+    def fit(self, values):
+        return cp.fit_quadrature(self.polynomials, self.nodes, self.weights, values)
+
+    def expect(self, poly):
+        if self.pdf is None:
+            raise ValueError("The distribution of an unpickled UQContext is unavailable.")
+        return cp.E(poly=poly, dist=self.pdf)
+
+    def fit_and_expect(self, values):
+        """ The values may have trailing dimensions, e.g. (n, ...) for several quantities at each node. """
+        return np.tensordot(self.expectation, np.asarray(values, dtype=float), axes=(0,0))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pdf'] = None
+        return state
+
+
+_contexts = OrderedDict()
+CONTEXT_CACHE_SIZE = 8
+
+def getContext(pdf, order=2, rule="G"):
+    ''' Returns the UQContext of a distribution, order and quadrature rule, reusing the most recently used contexts. '''
+
+    key = (str(pdf), order, rule)
+    try:
+        context = _contexts.pop(key)
+    except KeyError:
+        context = UQContext(pdf, order, rule)
+        if len(_contexts) >= CONTEXT_CACHE_SIZE:
+            _contexts.popitem(last=False)
+    _contexts[key] = context
+    return context
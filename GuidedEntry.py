@@ -15,6 +15,7 @@ from EntryGuidance.Triggers import DeployParachute, findTriggerPoint, AltitudeTr
 from EntryGuidance.ParametrizedPlanner import Optimize, HEPBankReducedSmooth, OptimizeSmooth
 
 from EntryGuidance.Simulation import Simulation, SRP
+from EntryGuidance.MonteCarlo import parallelMap, ResultStore
 
 def Simulate(sample=None):
     if sample is not None:
@@ -42,7 +43,7 @@ def Simulate(sample=None):
     
     idx = findTriggerPoint(X,time)
     istart = np.argmax(X[0:idx,3])
-    range = [entry.planet.range(*x0[[1,2,5]],lonc=np.radians(lon),latc=np.radians(lat),km=True) for lon,lat in zip(X[0:idx,1],X[0:idx,2])]
+    DR,CR = entry.planet.range(*x0[[1,2,5]],lonc=X[0:idx,1],latc=X[0:idx,2],km=True)
 
     # #In reality, need to compute the range to go to target. The initial condition in entry is set to the range to ignition?
     # entry.ignite(AltitudeTrigger(0.0)) # Initializes the srp phase and sets a condition for terminating the simulation
@@ -89,20 +90,45 @@ if __name__ == '__main__':
 
     # Parse Arguments and Setup Pool Environment
     mp.freeze_support()
-    # pool = mp.Pool(mp.cpu_count()/2.)
-    pool = mp.Pool(4)
     parser = ArgumentParser('Guided Entry Simulation')
     parser.add_argument('--type',   type=str,           default='baseline', help='Type of simulation(s) to run, [baseline, mc, qmc, pce]')
     parser.add_argument('--no_save',action='store_true',                    help='Flag to turn off saving the results.')
     parser.add_argument('--n',      type=int,           default=1,          help='Number of monte carlo cases to run, integer')
     parser.add_argument('--name',   type=str,           default=None,          help='Filename to save, string [optional]')
     parser.add_argument('--dir',    type=str,           default=None,          help='Directory in which to save with no leading or trailing slashes, string [optional]')
+    parser.add_argument('--workers',type=int,           default=None,          help='Number of worker processes, integer [optional, defaults to the number of cpus]')
+    parser.add_argument('--chunksize',type=int,         default=None,          help='Number of samples sent to a worker at a time, integer [optional]')
+    parser.add_argument('--mat',    action='store_true',                    help='Flag to also export stored results to a single .mat file, which loads them all into memory.')
 
     
     args = parser.parse_known_args()[0]
     print "Running {0} simulation".format(args.type)
     
     n = args.n;
+    Map = lambda samples, store=None, indices=None: parallelMap(Simulate, samples, workers=args.workers, chunksize=args.chunksize,
+                                                                callback=store, collect=store is None, indices=indices, output=True)
+
+    def Checkpointed(name, draw):
+        ''' Runs the samples from draw(), or those of an interrupted run of the same size, that are not yet in the store saveDir+name. '''
+        store = ResultStore(saveDir+name)
+        if store.samples is not None and store.samples.shape[1] == n:
+            samples = store.samples
+        else:
+            samples = draw()
+        store.bind(samples, (args.type, n))                        # Refuses to mix results from different samples or campaign types
+        missing = store.missing()
+        print "{} of {} samples already complete".format(samples.shape[1]-len(missing), samples.shape[1])
+        Map(samples.T, store, missing)
+        store.flush()
+        return samples, store
+    def MonteCarloSamples():
+        ''' Returns the samples of the mc campaign in saveDir, from its store or from an exported MC.mat. '''
+        if os.path.exists(os.path.join(saveDir+'MC', 'samples.npy')):
+            return ResultStore(saveDir+'MC').samples
+        if os.path.exists(saveDir+'MC.mat'):
+            return loadmat(saveDir+'MC')['samples']
+        raise IOError("No Monte Carlo samples in {0}, run --type mc with the same --dir first.".format(saveDir))
+        
     if args.dir is not None:
         saveDir = './data/{0}/'.format(args.dir)
     else:
@@ -130,19 +156,27 @@ if __name__ == '__main__':
             savemat(saveDir+'Baseline',{'states':states, 'samples':sample,'index':index})
 
     elif args.type == 'mc':
-        samples = pdf.sample(n)    
+        if args.no_save:
+            samples = pdf.sample(n)
+            stateTensor = Map(samples.T)
+        else:
+            samples, store = Checkpointed('MC', lambda: pdf.sample(n))  # Trajectories are written to disk as they complete
+            if args.mat:
+                store.savemat(saveDir+'MC', samples=samples)
         p = pdf.pdf(samples)
 
-        stateTensor = pool.map(Simulate,samples.T)
-        savemat(saveDir+'MC',{'states':stateTensor, 'samples':samples})
-
     else: # Polynomial Chaos Expansion !!!!
+        pceTestPoints = MonteCarloSamples()     # Checked before running, for an apples-to-apples comparison with the MC samples
         if args.type == 'qmc':
             #Quasi MonteCarlo with 1/4 number of MC samples and PCE built from it
-            samples = pdf.sample(n,'S')
-            stateTensor = pool.map(Simulate,samples.T)
-            if not args.no_save:
-                savemat(saveDir+'SobolMC',{'states':stateTensor, 'samples':samples})
+            if args.no_save:
+                samples = pdf.sample(n,'S')
+                stateTensor = Map(samples.T)
+            else:
+                samples, store = Checkpointed('SobolMC', lambda: pdf.sample(n,'S'))
+                stateTensor = store.tensor()
+                if args.mat:
+                    store.savemat(saveDir+'SobolMC', samples=samples)
             
             # data = loadmat('./data/SobolMC')
             # samples = data['samples']
@@ -152,12 +186,14 @@ if __name__ == '__main__':
         elif args.type == 'pce':
             #Quadrature based PCE
             polynomials = cp.orth_ttr(order=2, dist=pdf)
-            samples,weights = cp.generate_quadrature(order=2, domain=pdf, rule="Gaussian")
-            stateTensor = pool.map(Simulate,samples.T)
+            samples,weights = cp.generate_quadrature(2, pdf, rule="G")
+            if args.no_save:
+                stateTensor = Map(samples.T)
+            else:
+                n = samples.shape[1]
+                stateTensor = Checkpointed('PCE', lambda: samples)[1].tensor()
             PCE = cp.fit_quadrature(polynomials,samples,weights,stateTensor)
             
-        data = loadmat(saveDir+'MC') #Load the MC samples for an apples-to-apples comparison
-        pceTestPoints = data['samples']    
         stateTensorPCE = np.array([PCE(*point) for point in pceTestPoints.T])
         Expectation = cp.E(poly=PCE,dist=pdf)
         if not args.no_save:      
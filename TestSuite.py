@@ -6,7 +6,7 @@ from scipy.optimize import minimize, differential_evolution
 import chaospy as cp
 
 from EntryGuidance.EntryEquations import System
-from EntryGuidance.Uncertainty import getUncertainty
+from EntryGuidance.Uncertainty import getUncertainty, getContext
 
 
 def Optimize():
@@ -56,15 +56,14 @@ def OptCost(sample, gain):
 
 def OptCostRS(gain, pdf):
 
-    polynomials = cp.orth_ttr(order=2, dist=pdf)
-    samples,weights = cp.generate_quadrature(order=2, domain=pdf, rule="Gaussian")
-    stateTensor = [OptCost(s,gain) for s in samples.T]
+    context = getContext(pdf)
+    stateTensor = [OptCost(s,gain) for s in context.nodes.T]
     # stateTensor = pool.map(OptCost,samples.T)
-    PCE = cp.fit_quadrature(polynomials,samples,weights,stateTensor)
+    J = context.fit_and_expect(stateTensor)
     
     print "\nGain = {}".format(gain)
-    print "PCE Expectation: {} ".format(cp.E(poly=PCE,dist=pdf))
-    return cp.E(poly=PCE,dist=pdf)
+    print "PCE Expectation: {} ".format(J)
+    return J
 
 
 def testFilters(sample=None):